@@ -0,0 +1,243 @@
+'''
+Memory-bounded aggregation table
+
+* Copyright 2016, Amazon.com, Inc. or its affiliates. All Rights Reserved.
+*
+* Licensed under the Amazon Software License (the "License").
+* You may not use this file except in compliance with the License.
+* A copy of the License is located at
+*
+* http://aws.amazon.com/asl/
+*
+* or in the "license" file accompanying this file. This file is distributed
+* on an "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either
+* express or implied. See the License for the specific language governing
+* permissions and limitations under the License.
+'''
+
+from concurrent.futures import ThreadPoolExecutor
+import heapq
+import json
+import operator
+import os
+import s3io
+import tempfile
+import threading
+import zlib
+
+# dict 항목 하나가 차지하는 대략적인 메모리 (dict slot + str 객체 + float 객체, bytes)
+ENTRY_OVERHEAD = 160
+
+# memory budget이 지정되지 않았을 때 Lambda 메모리 중 aggregation table에 사용할 비율
+DEFAULT_MEMORY_FRACTION = 0.25
+
+SPILL_DIR = "/tmp"
+
+# 한 번에 merge 하는 run 파일 수. (Lambda의 file descriptor 한도는 1024)
+MAX_MERGE_RUNS = 64
+
+# 결과 shard마다 MIN_PART_SIZE의 buffer를 사용하므로 shard 수를 제한합니다. (약 16 * 5MB)
+MAX_RESULT_SHARDS = 16
+
+
+def memory_budget_bytes(budget_mb, context):
+    '''
+    aggregation table의 memory budget(bytes)을 결정합니다.
+    지정된 값이 없다면 Lambda 메모리 크기의 일부를 사용합니다.
+    '''
+    if budget_mb:
+        return int(float(budget_mb) * 1024 * 1024)
+    lambda_memory = int(getattr(context, 'memory_limit_in_mb', 1536))
+    return int(lambda_memory * DEFAULT_MEMORY_FRACTION * 1024 * 1024)
+
+
+class AggregationTable(object):
+    '''
+    key별로 값을 합치는(combine) dict 입니다.
+    예상 메모리 사용량이 budget을 넘으면 정렬된 부분 결과(run)를 /tmp에 내보내고(spill),
+    items()에서 모든 run을 k-way merge 합니다. run이 MAX_MERGE_RUNS개보다 많으면
+    먼저 MAX_MERGE_RUNS개씩 중간 run으로 merge 하여 동시에 여는 파일 수를 제한합니다.
+    '''
+
+    def __init__(self, memory_budget, combine=operator.add, spill_dir=SPILL_DIR):
+        self.memory_budget = memory_budget
+        self.combine = combine
+        self.spill_dir = spill_dir
+        self.table = {}
+        self.mem_used = 0
+        self.runs = []
+
+    def add(self, key, value):
+        if key in self.table:
+            self.table[key] = self.combine(self.table[key], value)
+            return
+        self.table[key] = value
+        self.mem_used += len(key) + ENTRY_OVERHEAD
+        if self.mem_used >= self.memory_budget:
+            self.spill()
+
+    @property
+    def spilled(self):
+        return len(self.runs) > 0
+
+    def spill(self):
+        '''
+        메모리의 항목을 key 순서로 정렬해 /tmp의 run 파일로 내보냅니다.
+        '''
+        if not self.table:
+            return
+        path = self._write_run((key, self.table[key]) for key in sorted(self.table))
+        print("Spilled %s keys to %s" % (len(self.table), path))
+        self.runs.append(path)
+        self.table = {}
+        self.mem_used = 0
+
+    def _write_run(self, items):
+        fd, path = tempfile.mkstemp(prefix="spill-", suffix=".run", dir=self.spill_dir)
+        with os.fdopen(fd, 'w') as f:
+            for key, value in items:
+                f.write(json.dumps([key, value]))
+                f.write('\n')
+        return path
+
+    def _read_run(self, path):
+        with open(path) as f:
+            for line in f:
+                key, value = json.loads(line)
+                yield key, value
+
+    def items(self):
+        '''
+        (key, value)를 반환합니다. spill이 있었다면 모든 run과 메모리의 항목을 key 순서로 merge 합니다.
+        '''
+        if not self.runs:
+            for item in self.table.items():
+                yield item
+            return
+
+        # 오래된 run부터 MAX_MERGE_RUNS개씩 하나의 run으로 합칩니다.
+        while len(self.runs) > MAX_MERGE_RUNS:
+            batch = self.runs[:MAX_MERGE_RUNS]
+            path = self._write_run(self._merge([self._read_run(p) for p in batch]))
+            print("Merged %s runs into %s" % (len(batch), path))
+            self.runs = self.runs[MAX_MERGE_RUNS:] + [path]
+            for p in batch:
+                os.remove(p)
+
+        in_memory = sorted(self.table.items(), key=operator.itemgetter(0))
+        streams = [self._read_run(path) for path in self.runs] + [iter(in_memory)]
+        for item in self._merge(streams):
+            yield item
+
+    def _merge(self, streams):
+        '''
+        key 순서로 정렬된 stream들을 merge 하면서 같은 key의 값을 합칩니다.
+        '''
+        current_key = None
+        current_value = None
+        for key, value in heapq.merge(*streams, key=operator.itemgetter(0)):
+            if key == current_key:
+                current_value = self.combine(current_value, value)
+                continue
+            if current_key is not None:
+                yield current_key, current_value
+            current_key, current_value = key, value
+        if current_key is not None:
+            yield current_key, current_value
+
+    def __len__(self):
+        return len(self.table)
+
+    def close(self):
+        '''
+        /tmp의 run 파일을 제거합니다. (warm container에서 /tmp가 재사용되므로 반드시 호출합니다.)
+        '''
+        for path in self.runs:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+        self.runs = []
+        self.table = {}
+        self.mem_used = 0
+
+
+class JsonDictWriter(object):
+    '''
+    (key, value)를 dict 형식의 JSON으로 파일(또는 s3io.MultipartWriter)에 순차적으로 씁니다.
+    json.dumps(dict)와 같은 결과를 전체 dict를 메모리에 만들지 않고 생성합니다.
+    '''
+
+    def __init__(self, f):
+        self.f = f
+        self.count = 0
+        f.write('{')
+
+    def add(self, key, value):
+        self.f.write('%s%s: %s' % (', ' if self.count else '', json.dumps(key), json.dumps(value)))
+        self.count += 1
+
+    def close(self):
+        self.f.write('}')
+
+
+def dump_json(items, f):
+    '''
+    (key, value) iterator를 dict 형식의 JSON으로 파일에 순차적으로 씁니다.
+    '''
+    out = JsonDictWriter(f)
+    for key, value in items:
+        out.add(key, value)
+    out.close()
+
+
+def write_items_to_s3(s3_client, bucket, key, items, metadata):
+    '''
+    aggregation 결과를 JSON으로 직렬화하면서 바로 S3에 업로드합니다.
+    part 크기를 넘는 결과는 multipart upload로 part를 채우는 대로 병렬 전송합니다.
+    '''
+    with s3io.MultipartWriter(s3_client, bucket, key, metadata) as f:
+        dump_json(items, f)
+
+
+def shard_of(key, n_shards):
+    '''
+    key가 저장될 result shard 번호. (process에 관계없이 같은 값을 갖도록 crc32를 사용합니다)
+    '''
+    return zlib.crc32(key.encode('utf-8')) % n_shards
+
+
+def write_sharded_items_to_s3(s3_client, bucket, keys, items, metadata):
+    '''
+    aggregation 결과를 key의 hash로 나누어 len(keys)개의 JSON object에 동시에 업로드합니다.
+    각 shard는 서로 다른 key를 가진 독립적인 JSON dict이며, 저장된 크기(bytes) 목록을 반환합니다.
+    메모리 사용량은 약 (len(keys) + DEFAULT_UPLOAD_THREADS) * MIN_PART_SIZE 입니다.
+    '''
+    if len(keys) > MAX_RESULT_SHARDS:
+        raise ValueError("at most %s result shards are supported" % MAX_RESULT_SHARDS)
+    executor = ThreadPoolExecutor(s3io.DEFAULT_UPLOAD_THREADS)
+    # shard마다 part buffer를 가지므로 part 크기와 대기 part 수를 최소로 제한하고,
+    # 모든 shard의 업로드 중인 part 수는 upload thread 수로 제한합니다.
+    part_slots = threading.Semaphore(s3io.DEFAULT_UPLOAD_THREADS)
+    writers = [s3io.MultipartWriter(s3_client, bucket, key, metadata, part_size=s3io.MIN_PART_SIZE,
+                                    executor=executor, max_pending=1, part_slots=part_slots) for key in keys]
+    try:
+        shards = [JsonDictWriter(w) for w in writers]
+        for key, value in items:
+            shards[shard_of(key, len(shards))].add(key, value)
+        for shard in shards:
+            shard.close()
+        # 작은 shard는 close에서 put_object로 저장되므로 close도 병렬로 실행합니다.
+        # (close는 part 업로드를 기다리므로 part를 업로드하는 executor와 다른 pool을 사용합니다)
+        close_pool = ThreadPoolExecutor(min(len(writers), s3io.DEFAULT_UPLOAD_THREADS))
+        try:
+            list(close_pool.map(lambda w: w.close(), writers))
+        finally:
+            close_pool.shutdown()
+    except Exception:
+        for w in writers:
+            w.abort()
+        raise
+    finally:
+        executor.shutdown()
+    return [w.size for w in writers]
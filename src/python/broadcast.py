@@ -0,0 +1,189 @@
+'''
+Broadcast (map-side) join tables with warm-container caching
+
+* Copyright 2016, Amazon.com, Inc. or its affiliates. All Rights Reserved.
+*
+* Licensed under the Amazon Software License (the "License").
+* You may not use this file except in compliance with the License.
+* A copy of the License is located at
+*
+* http://aws.amazon.com/asl/
+*
+* or in the "license" file accompanying this file. This file is distributed
+* on an "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either
+* express or implied. See the License for the specific language governing
+* permissions and limitations under the License.
+'''
+
+from array import array
+import hashlib
+import os
+import struct
+import sys
+import threading
+
+CACHE_DIR = "/tmp"
+TABLE_MAGIC = b'BCT1'
+
+# warm container에서 재사용되는 module level cache: (bucket, key, keyField, valueField) -> (etag, BroadcastTable)
+_tables = {}
+_tables_lock = threading.Lock()
+
+
+class BroadcastTable(object):
+    '''
+    정렬된 key를 하나의 bytes에 이어 붙이고 offset 배열로 찾는 읽기 전용 lookup table 입니다.
+    값은 중복을 제거해 index 배열로 저장하므로 dict보다 메모리를 적게 사용하고,
+    /tmp에 그대로 저장하고 읽을 수 있습니다.
+    '''
+
+    def __init__(self, blob, offsets, value_ids, values):
+        self.blob = blob
+        self.offsets = offsets
+        self.value_ids = value_ids
+        self.values = values
+
+    @classmethod
+    def build(cls, pairs):
+        '''
+        (key, value) 목록으로 table을 만듭니다. 같은 key가 여러 번 나오면 마지막 값을 사용합니다.
+        '''
+        latest = {}
+        for key, value in pairs:
+            latest[key.encode('utf-8')] = value
+        value_index = {}
+        values = []
+        offsets = array('I', [0])
+        value_ids = array('I')
+        parts = []
+        pos = 0
+        for key in sorted(latest):
+            value = latest[key]
+            if value not in value_index:
+                value_index[value] = len(values)
+                values.append(value)
+            parts.append(key)
+            pos += len(key)
+            offsets.append(pos)
+            value_ids.append(value_index[value])
+        return cls(b''.join(parts), offsets, value_ids, values)
+
+    def __len__(self):
+        return len(self.value_ids)
+
+    def get(self, key, default=None):
+        if key is None:
+            return default
+        k = key.encode('utf-8')
+        lo, hi = 0, len(self.value_ids)
+        blob, offsets = self.blob, self.offsets
+        while lo < hi:
+            mid = (lo + hi) // 2
+            probe = blob[offsets[mid]:offsets[mid + 1]]
+            if probe < k:
+                lo = mid + 1
+            elif probe > k:
+                hi = mid
+            else:
+                return self.values[self.value_ids[mid]]
+        return default
+
+    def to_bytes(self):
+        values = '\n'.join(self.values).encode('utf-8')
+        offsets = array('I', self.offsets)
+        value_ids = array('I', self.value_ids)
+        if sys.byteorder != 'little':
+            offsets.byteswap()
+            value_ids.byteswap()
+        return b''.join([
+            TABLE_MAGIC,
+            struct.pack('<IIII', len(self.value_ids), len(self.blob), len(values), len(self.values)),
+            offsets.tobytes(), value_ids.tobytes(), self.blob, values
+        ])
+
+    @classmethod
+    def from_bytes(cls, data):
+        if data[:4] != TABLE_MAGIC:
+            raise ValueError("Not a broadcast table")
+        n, blob_len, values_len, n_values = struct.unpack_from('<IIII', data, 4)
+        pos = 20
+        offsets = array('I')
+        offsets.frombytes(data[pos:pos + 4 * (n + 1)])
+        pos += 4 * (n + 1)
+        value_ids = array('I')
+        value_ids.frombytes(data[pos:pos + 4 * n])
+        pos += 4 * n
+        if sys.byteorder != 'little':
+            offsets.byteswap()
+            value_ids.byteswap()
+        blob = data[pos:pos + blob_len]
+        pos += blob_len
+        values = data[pos:pos + values_len].decode('utf-8').split('\n') if n_values else []
+        return cls(blob, offsets, value_ids, values)
+
+
+def parse_csv(contents, key_field, value_field):
+    for line in contents.decode('utf-8').split('\n'):
+        if not line:
+            continue
+        data = line.split(',')
+        try:
+            yield data[key_field], data[value_field]
+        except IndexError:
+            print("Skipping malformed broadcast row", line)
+
+
+def _table_id(spec):
+    '''
+    같은 side table이라도 key/value column이 다르면 다른 table 입니다.
+    '''
+    return (spec["bucket"], spec["key"], spec.get("keyField", 0), spec.get("valueField", 1))
+
+
+def _cache_path(spec, etag):
+    # 이전 버전(ETag)의 파일만 지우도록, prefix에는 table을 구분하는 값을 모두 포함합니다.
+    name = hashlib.sha1(("%s/%s:%s:%s" % _table_id(spec)).encode('utf-8')).hexdigest()[:16]
+    version = hashlib.sha1(etag.encode('utf-8')).hexdigest()[:16]
+    return os.path.join(CACHE_DIR, "broadcast-%s-%s.bin" % (name, version)), "broadcast-%s-" % name
+
+
+def load_table(s3_client, spec):
+    '''
+    broadcast table을 가져옵니다.
+    1) 같은 ETag라면 module level cache, 2) /tmp의 직렬화된 table, 3) S3에서 다운로드 후 생성 순서로 찾습니다.
+    spec: {"bucket", "key", "keyField", "valueField", "etag"(선택, driver가 조회)}
+    '''
+    etag = spec.get("etag")
+    if etag is None:
+        etag = s3_client.head_object(Bucket=spec["bucket"], Key=spec["key"])['ETag']
+    with _tables_lock:
+        return _load_table(s3_client, spec, etag)
+
+
+def _load_table(s3_client, spec, etag):
+    cache_key = _table_id(spec)
+    cached = _tables.get(cache_key)
+    if cached is not None and cached[0] == etag:
+        return cached[1]
+
+    path, stale_prefix = _cache_path(spec, etag)
+    if os.path.exists(path):
+        with open(path, 'rb') as f:
+            table = BroadcastTable.from_bytes(f.read())
+        print("Loaded broadcast table from", path)
+    else:
+        response = s3_client.get_object(Bucket=spec["bucket"], Key=spec["key"], IfMatch=etag)
+        table = BroadcastTable.build(parse_csv(response['Body'].read(),
+                                               spec.get("keyField", 0), spec.get("valueField", 1)))
+        # 이전 버전(ETag)의 파일을 지우고, 다른 invocation이 읽는 중에도 안전하도록 rename으로 저장합니다.
+        for fname in os.listdir(CACHE_DIR):
+            if fname.startswith(stale_prefix):
+                os.remove(os.path.join(CACHE_DIR, fname))
+        tmp_path = path + ".%s.tmp" % os.getpid()
+        with open(tmp_path, 'wb') as f:
+            f.write(table.to_bytes())
+        os.rename(tmp_path, path)
+        print("Built broadcast table with %s keys" % len(table))
+
+    _tables[cache_key] = (etag, table)
+    return table
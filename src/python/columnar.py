@@ -0,0 +1,224 @@
+'''
+Columnar (Parquet) input with projection and predicate pushdown
+
+* Copyright 2016, Amazon.com, Inc. or its affiliates. All Rights Reserved.
+*
+* Licensed under the Amazon Software License (the "License").
+* You may not use this file except in compliance with the License.
+* A copy of the License is located at
+*
+* http://aws.amazon.com/asl/
+*
+* or in the "license" file accompanying this file. This file is distributed
+* on an "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either
+* express or implied. See the License for the specific language governing
+* permissions and limitations under the License.
+'''
+
+import io
+import operator
+
+try:
+    import pyarrow.parquet as pq
+except ImportError:  # pyarrow는 parquet 입력을 사용할 때만 필요합니다. (mapper에는 Lambda layer로 추가)
+    pq = None
+
+PARQUET = "parquet"
+CSV = "csv"
+
+# 작은 range 요청을 줄이기 위한 최소 read 크기 (footer, page header 등)
+MIN_RANGE_READ = 64 * 1024
+
+FILTER_OPS = {
+    "=": operator.eq,
+    "==": operator.eq,
+    "!=": operator.ne,
+    "<": operator.lt,
+    "<=": operator.le,
+    ">": operator.gt,
+    ">=": operator.ge,
+}
+
+
+def require_pyarrow():
+    if pq is None:
+        raise RuntimeError("parquet input requires pyarrow (add a pyarrow Lambda layer to the mapper)")
+
+
+class S3RangeFile(io.RawIOBase):
+    '''
+    S3 object를 ranged GET으로 읽는 seek 가능한 file 객체입니다.
+    pyarrow는 footer와 필요한 column chunk의 범위만 읽습니다.
+    '''
+
+    def __init__(self, s3_client, bucket, key, size=None):
+        self.s3_client = s3_client
+        self.bucket = bucket
+        self.key = key
+        if size is None:
+            size = s3_client.head_object(Bucket=bucket, Key=key)['ContentLength']
+        self.size = size
+        self.pos = 0
+        self.bytes_read = 0
+        self.requests = 0
+        self._buf_start = 0
+        self._buf = b''
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self.pos
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_SET:
+            self.pos = offset
+        elif whence == io.SEEK_CUR:
+            self.pos += offset
+        else:
+            self.pos = self.size + offset
+        return self.pos
+
+    def _fetch(self, start, end):
+        self.requests += 1
+        response = self.s3_client.get_object(Bucket=self.bucket, Key=self.key,
+                                             Range='bytes=%s-%s' % (start, end - 1))
+        data = response['Body'].read()
+        self.bytes_read += len(data)
+        return data
+
+    def read(self, n=-1):
+        if n is None or n < 0:
+            n = self.size - self.pos
+        end = min(self.pos + n, self.size)
+        if self.pos >= end:
+            return b''
+
+        buf_end = self._buf_start + len(self._buf)
+        if not (self._buf_start <= self.pos and end <= buf_end):
+            fetch_end = min(max(end, self.pos + MIN_RANGE_READ), self.size)
+            self._buf_start = self.pos
+            self._buf = self._fetch(self.pos, fetch_end)
+
+        data = self._buf[self.pos - self._buf_start:end - self._buf_start]
+        self.pos = end
+        return data
+
+    def readinto(self, b):
+        data = self.read(len(b))
+        b[:len(data)] = data
+        return len(data)
+
+
+def _column_stats(rg_meta, name):
+    for j in range(rg_meta.num_columns):
+        col = rg_meta.column(j)
+        if col.path_in_schema == name:
+            stats = col.statistics
+            if stats is not None and stats.has_min_max:
+                return stats.min, stats.max
+            return None
+    return None
+
+
+def row_group_may_match(rg_meta, filters):
+    '''
+    row group의 min/max 통계로 filter를 만족하는 row가 있을 수 있는지 확인합니다.
+    filters: [[column, op, value], ...] (AND)
+    '''
+    for name, op, value in filters or []:
+        stats = _column_stats(rg_meta, name)
+        if stats is None:
+            continue
+        lo, hi = stats
+        try:
+            if op in ("=", "==") and (value < lo or value > hi):
+                return False
+            if op == "<" and not lo < value:
+                return False
+            if op == "<=" and not lo <= value:
+                return False
+            if op == ">" and not hi > value:
+                return False
+            if op == ">=" and not hi >= value:
+                return False
+            if op == "!=" and lo == hi == value:
+                return False
+        except TypeError:
+            continue
+    return True
+
+
+def _projected_size(rg_meta, names):
+    return sum(rg_meta.column(j).total_compressed_size for j in range(rg_meta.num_columns)
+               if rg_meta.column(j).path_in_schema in names)
+
+
+def plan_row_group_splits(s3_client, bucket, obj, columns, filters=None):
+    '''
+    Parquet object의 footer를 읽어 row group 단위의 split 목록을 만듭니다.
+    통계로 제외되는 row group은 포함하지 않으며, Size는 읽어야 할 column chunk의 크기입니다.
+    '''
+    require_pyarrow()
+    names = set(columns) | set(f[0] for f in filters or [])
+    f = S3RangeFile(s3_client, bucket, obj.key, obj.size)
+    metadata = pq.ParquetFile(f).metadata
+    splits = []
+    for i in range(metadata.num_row_groups):
+        rg_meta = metadata.row_group(i)
+        if not row_group_may_match(rg_meta, filters):
+            continue
+        splits.append({"Key": obj.key, "RowGroup": i, "Size": _projected_size(rg_meta, names),
+                       "ObjectSize": obj.size})
+    return splits
+
+
+class ParquetReader(object):
+    '''
+    mapper에서 split(row group)의 projection된 column만 읽어 columns 순서의 row tuple을 반환합니다.
+    '''
+
+    def __init__(self, s3_client, bucket, columns, filters=None):
+        require_pyarrow()
+        self.s3_client = s3_client
+        self.bucket = bucket
+        self.columns = columns
+        self.raw_filters = filters or []
+        self.filters = [(name, FILTER_OPS[op], value) for name, op, value in self.raw_filters]
+        self.read_columns = list(columns) + [f[0] for f in self.filters if f[0] not in columns]
+        self.bytes_read = 0
+        self.skipped_row_groups = 0
+        self._file = None
+        self._pf = None
+
+    def _open(self, key, size):
+        if self._file is not None and self._file.key == key:
+            return self._pf
+        if self._file is not None:
+            self.bytes_read += self._file.bytes_read
+        self._file = S3RangeFile(self.s3_client, self.bucket, key, size)
+        self._pf = pq.ParquetFile(self._file)
+        return self._pf
+
+    def read_split(self, split):
+        pf = self._open(split["key"], split.get("size"))
+        rg = split["rowGroup"]
+        if not row_group_may_match(pf.metadata.row_group(rg), self.raw_filters):
+            self.skipped_row_groups += 1
+            return
+        table = pf.read_row_group(rg, columns=self.read_columns)
+        cols = [table.column(name).to_pylist() for name in self.read_columns]
+        out_cols = cols[:len(self.columns)]
+        filter_cols = [(cols[self.read_columns.index(name)], fn, value) for name, fn, value in self.filters]
+        for i in range(table.num_rows):
+            if all(col[i] is not None and fn(col[i], value) for col, fn, value in filter_cols):
+                yield tuple(col[i] for col in out_cols)
+
+    def close(self):
+        if self._file is not None:
+            self.bytes_read += self._file.bytes_read
+        self._file = None
+        self._pf = None
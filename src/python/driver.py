@@ -17,6 +17,7 @@
  * permissions and limitations under the License. 
 '''
 
+import argparse
 import boto3
 import json
 import math
@@ -25,8 +26,14 @@ import re
 from io import StringIO
 import sys
 import time
+import uuid
 
+import aggregator
+import columnar
+import jobtrace
 import lambdautils
+import s3io
+import sketches
 
 import glob
 import subprocess 
@@ -39,40 +46,99 @@ from botocore.client import Config
 s3 = boto3.resource('s3')
 s3_client = boto3.client('s3')
 
-JOB_INFO = 'jobinfo.json'
+# 비동기(Event) 호출의 payload 제한과 기본 dispatch thread 수
+ASYNC_PAYLOAD_LIMIT = 256 * 1024
+DEFAULT_DISPATCH_THREADS = 16
+# 비동기 호출의 재시도 횟수와 기본 최대 event 대기 시간(Lambda의 기본값, 6시간)
+ASYNC_RETRY_ATTEMPTS = 2
+DEFAULT_MAX_EVENT_AGE = 6 * 60 * 60
+
+# driverconfig.json에 deploymentId가 없을 때 사용하는 배포 이름
+DEFAULT_DEPLOYMENT_ID = "bl-release"
+
+# 모든 Lambda 함수에 같이 패키징되는 공용 모듈
+SHARED_MODULES = ["lambdautils.py", "aggregator.py", "sketches.py", "columnar.py", "broadcast.py", "s3io.py"]
 
 ### utils ####
 # 라이브러리와 코드 zip 패키징 
 def zipLambda(fname, zipname):
     # faster to zip with shell exec
-    subprocess.call(['zip', zipname] + glob.glob(fname) + glob.glob(JOB_INFO) +
-                        glob.glob("lambdautils.py"))
+    # job 설정은 zip에 포함하지 않습니다. (event 또는 S3의 job manifest로 전달)
+    subprocess.call(['zip', zipname] + glob.glob(fname) +
+                        [m for mod in SHARED_MODULES for m in glob.glob(mod)])
 
 # S3 Bucket에 file name(key), json(data) 저장
 def write_to_s3(bucket, key, data, metadata):
     s3.Bucket(bucket).put_object(Key=key, Body=data, Metadata=metadata)
 
-# 실행 중인 job에 대한 정보를 json 으로 로컬에 저장
-def write_job_config(job_id, job_bucket, n_mappers, r_func, r_handler):
-    fname = "jobinfo.json"
-    with open(fname, 'w') as f:
-        data = json.dumps({
-            "jobId": job_id,
-            "jobBucket" : job_bucket,
-            "mapCount": n_mappers,
-            "reducerFunction": r_func,
-            "reducerHandler": r_handler
-            }, indent=4)
-        f.write(data)
+# incremental job의 상태(처리한 입력과 이전 결과)를 저장하는 key
+def incremental_state_key(deployment_id, name):
+    return "incremental/%s/%s.json" % (deployment_id, name)
+
+# 이전 incremental job의 상태를 가져옵니다. 없다면 None
+def read_incremental_state(bucket, key):
+    try:
+        return json.loads(s3_client.get_object(Bucket=bucket, Key=key)['Body'].read())
+    except s3_client.exceptions.NoSuchKey:
+        return None
+
+# 입력 object를 이전에 처리한 입력(key -> ETag)과 비교해 (새 object, 변경/삭제된 key)로 나눕니다.
+def diff_inputs(objs, processed):
+    new_objs = []
+    changed = []
+    for obj in objs:
+        if obj.key not in processed:
+            new_objs.append(obj)
+        elif processed[obj.key] != obj.e_tag:
+            changed.append(obj.key)
+    listed = set(obj.key for obj in objs)
+    changed += [k for k in processed if k not in listed]
+    return new_objs, changed
+
+# sharded result의 manifest에서 shard 목록([{"key", "size"}, ...])을 가져옵니다.
+def read_result_shards(bucket, key):
+    return json.loads(s3_client.get_object(Bucket=bucket, Key=key)['Body'].read())["resultShards"]
+
+# mapper event에 전달할 입력 단위 (CSV는 object key, Parquet은 row group split)
+def split_payload(k):
+    if isinstance(k, dict):
+        return {"key": k["Key"], "rowGroup": k["RowGroup"], "size": k["ObjectSize"]}
+    return k.key
 
 
 ######### MAIN ############# 
-## JOB ID 이름을 설정해주세요.
-job_id =  "bl-release"
+parser = argparse.ArgumentParser(description="Run a BigLambda MapReduce job")
+parser.add_argument("--job-id", help="job id (default: <deploymentId>/<timestamp>-<random>)")
+parser.add_argument("--deploy", action="store_true",
+                    help="always upload the Lambda code, even if the deployed code is unchanged")
+parser.add_argument("--trace", metavar="FILE",
+                    help="export a Chrome trace (Perfetto) JSON timeline of the job and print its critical path")
+parser.add_argument("--incremental", metavar="NAME",
+                    help="only map input objects that are new since the last run named NAME and merge them into its result")
+args = parser.parse_args()
+driver_start = time.time()
 
 # Config 파일
 config = json.loads(open('driverconfig.json', 'r').read())
 
+# 하나의 배포(deployment)된 mapper/reducer/coordinator를 여러 job이 동시에 공유합니다.
+# 모든 job의 S3 key는 <deploymentId>/<jobId 접미사>/ 아래에, task 출력은 <deploymentId>/task/<jobId 접미사>/ 아래에 저장됩니다.
+# (deploymentId가 없는 이전 설정 파일은 기존 이름을 사용합니다)
+deployment_id = config.get("deploymentId", DEFAULT_DEPLOYMENT_ID)
+if "/" in deployment_id:
+    raise ValueError("deploymentId must not contain '/'")
+if args.job_id:
+    job_id = args.job_id if args.job_id.startswith(deployment_id + "/") else deployment_id + "/" + args.job_id
+else:
+    job_id = "%s/%s-%s" % (deployment_id, time.strftime("%Y%m%d-%H%M%S"), uuid.uuid4().hex[:6])
+print("Job ID", job_id)
+
+# 각 단계의 시작/종료 시간을 기록합니다. (--trace)
+trace = jobtrace.JobTrace(job_id, driver_start) if args.trace else None
+def trace_span(name, start):
+    if trace is not None:
+        trace.add_driver_span(name, start, time.time())
+
 # 1. Driver Job에 대한 설정 파일driverconfig) json 파일의 모든 key-value를 저장
 bucket = config["bucket"]
 job_bucket = config["jobBucket"]
@@ -81,98 +147,230 @@ lambda_memory = config["lambdaMemory"] # lambda 실제 메모리
 concurrent_lambdas = config["concurrentLambdas"] # 동시 실행 가능 수
 lambda_read_timeout = config["lambda_read_timeout"]
 boto_max_connections = config["boto_max_connections"]
-
-# Lambda의 결과를 읽기 위한 timeout을 길게, connections pool을 많이 지정합니다.
-lambda_config = Config(read_timeout=lambda_read_timeout, max_pool_connections=boto_max_connections)
+# "Event"는 mapper를 비동기로 호출하고, 완료와 통계는 S3의 출력(metadata)에서 가져옵니다.
+invocation_type = config.get("invocationType", "RequestResponse")
+async_mappers = invocation_type == "Event"
+# 동시 실행 한도로 throttle 된 event는 이 시간(초) 동안 queue에 남아 재시도됩니다.
+max_event_age = config.get("maxEventAgeSeconds", DEFAULT_MAX_EVENT_AGE)
+dispatch_threads = config.get("dispatchThreads", DEFAULT_DISPATCH_THREADS)
+
+if async_mappers:
+    # 호출은 바로 반환되므로 작은 connection pool로 충분합니다.
+    lambda_config = Config(max_pool_connections=dispatch_threads)
+else:
+    # Lambda의 결과를 읽기 위한 timeout을 길게, connections pool을 많이 지정합니다.
+    lambda_config = Config(read_timeout=lambda_read_timeout, max_pool_connections=boto_max_connections)
 lambda_client = boto3.client('lambda', config=lambda_config)
 
 # prefix와 일치하는 모든 S3 bucket의 key를 가져옵니다.
+t_start = time.time()
 all_keys = []
 for obj in s3.Bucket(bucket).objects.filter(Prefix=config["prefix"]).all():
     all_keys.append(obj)
 
-bsize = lambdautils.compute_batch_size(all_keys, lambda_memory, concurrent_lambdas)
-batches = lambdautils.batch_creator(all_keys, bsize)
+# 최종 결과를 N개의 shard로 나누어 저장합니다. (sketch 결과는 크기가 작으므로 나누지 않습니다)
+result_shards = int(config.get("resultShards", 1))
+if result_shards > aggregator.MAX_RESULT_SHARDS:
+    raise ValueError("resultShards must be at most %s" % aggregator.MAX_RESULT_SHARDS)
+sharded_result = result_shards > 1 and not sketches.is_sketch(config.get("aggregation"))
+
+# Broadcast join: 작은 side table의 ETag를 한 번만 조회해 mapper에 전달합니다.
+# mapper는 같은 ETag의 table을 warm container의 메모리와 /tmp에서 재사용합니다.
+broadcast_spec = config.get("broadcast")
+if broadcast_spec:
+    broadcast_spec = dict(broadcast_spec)
+    broadcast_spec["etag"] = s3_client.head_object(Bucket=broadcast_spec["bucket"], Key=broadcast_spec["key"])['ETag']
+    print("Broadcast table", broadcast_spec["key"], broadcast_spec["etag"])
+
+# Incremental job: 이전 실행 이후 새로 추가된 object만 map 하고, 이전 결과를 reducer로 merge 합니다.
+input_keys = all_keys
+prior_result_keys = []
+if args.incremental:
+    inc_state_key = incremental_state_key(deployment_id, args.incremental)
+    inc_state = read_incremental_state(job_bucket, inc_state_key)
+    # 입력 형식, column, filter나 side table(ETag)이 다르면 이전 결과와 merge 할 수 없습니다.
+    same_job = inc_state is not None and \
+        [inc_state["bucket"], inc_state["prefix"], inc_state.get("aggregation"), inc_state.get("broadcast"),
+         inc_state.get("broadcastEtag"), inc_state.get("inputFormat", columnar.CSV), inc_state.get("columns"),
+         inc_state.get("filters")] == \
+        [bucket, config["prefix"], config.get("aggregation"), config.get("broadcast"),
+         broadcast_spec["etag"] if broadcast_spec else None, config.get("inputFormat", columnar.CSV),
+         config.get("columns"), config.get("filters")]
+    if inc_state is None:
+        print("No previous incremental state for", args.incremental, "- processing all input")
+    elif not same_job:
+        print("Job configuration or broadcast table changed since", inc_state["jobId"], "- processing all input")
+    else:
+        new_objs, changed = diff_inputs(all_keys, inc_state["inputs"])
+        if changed:
+            # 이미 merge된 결과에서 object의 기여분을 뺄 수 없으므로 전체를 다시 계산합니다.
+            print("%s previously processed objects changed or were removed - processing all input" % len(changed))
+        elif not new_objs:
+            print("No new input since", inc_state["jobId"], "- result:", inc_state["resultKey"])
+            sys.exit(0)
+        else:
+            print("Incremental run: %s new objects, merging into %s" % (len(new_objs), inc_state["resultKey"]))
+            input_keys = new_objs
+            if inc_state.get("resultSharded"):
+                prior_result_keys = [shard["key"] for shard in read_result_shards(job_bucket, inc_state["resultKey"])]
+            else:
+                prior_result_keys = [inc_state["resultKey"]]
+
+trace_span("list input", t_start)
+
+# Parquet 입력은 footer를 읽어 row group 단위로 스케줄합니다. (통계로 제외되는 row group은 읽지 않습니다)
+input_format = config.get("inputFormat", columnar.CSV)
+map_units = input_keys
+if input_format == columnar.PARQUET:
+    t_start = time.time()
+    plan_pool = ThreadPool(min(len(input_keys), 64))
+    read_columns = config["columns"] + ([config["broadcast"]["joinColumn"]] if config.get("broadcast") else [])
+    plan = partial(columnar.plan_row_group_splits, s3_client, bucket,
+                   columns=read_columns, filters=config.get("filters"))
+    map_units = [split for splits in plan_pool.map(plan, input_keys) for split in splits]
+    plan_pool.close()
+    trace_span("plan row groups", t_start)
+    print("Row group splits: %s of %s objects" % (len(map_units), len(input_keys)))
+    if not map_units:
+        print("No row group matches the filters")
+        sys.exit(0)
+
+bsize = lambdautils.compute_batch_size(map_units, lambda_memory, concurrent_lambdas)
+batches = lambdautils.batch_creator(map_units, bsize)
 n_mappers = len(batches) # 최종적으로 구한 batches의 개수가 mapper로 결정
+# 이전 결과(또는 결과의 각 shard)는 추가 mapper 출력으로 reducer에 전달됩니다.
+map_count = n_mappers + len(prior_result_keys)
+
+def mapper_payload(m_id):
+    '''
+    m_id번째 mapper의 호출 payload
+    '''
+    return json.dumps({
+        "bucket": bucket,
+        "keys": [split_payload(k) for k in batches[m_id-1]],
+        "jobBucket": job_bucket,
+        "jobId": job_id,
+        "mapperId": m_id,
+        "inputFormat": input_format,
+        "columns": config.get("columns"),
+        "filters": config.get("filters"),
+        "memoryBudgetMB": config.get("aggregationMemoryMB"),
+        "aggregation": config.get("aggregation"),
+        "broadcast": broadcast_spec,
+        "hashedKeys": config.get("hashedKeys", False)
+    })
+
+# 일부 mapper만 호출된 job이 남지 않도록, manifest를 쓰고 호출하기 전에 모든 payload의 크기를 확인합니다.
+payloads = [mapper_payload(m_id) for m_id in range(1, n_mappers + 1)]
+if async_mappers:
+    oversized = [(m_id, len(p)) for m_id, p in enumerate(payloads, 1) if len(p) > ASYNC_PAYLOAD_LIMIT]
+    if oversized:
+        raise ValueError("%s mapper payloads are larger than the %s bytes allowed for Event invocations "
+                         "(mapper %s: %s bytes)" % (len(oversized), ASYNC_PAYLOAD_LIMIT,
+                                                    oversized[0][0], oversized[0][1]))
 
 # 2. Lambda Function 을 생성합니다.
 L_PREFIX = "BL"
 
-# Lambda Functions 이름을 지정합니다.
-mapper_lambda_name = L_PREFIX + "-mapper-" +  job_id;
-reducer_lambda_name = L_PREFIX + "-reducer-" +  job_id; 
-rc_lambda_name = L_PREFIX + "-rc-" +  job_id;
-
-# Job 환경 설정을 json으로 파일 씁니다.
-write_job_config(job_id, job_bucket, n_mappers, reducer_lambda_name, config["reducer"]["handler"]);
+# Lambda Functions 이름을 지정합니다. (job이 아닌 deployment 단위)
+mapper_lambda_name = L_PREFIX + "-mapper-" +  deployment_id;
+reducer_lambda_name = L_PREFIX + "-reducer-" +  deployment_id; 
+rc_lambda_name = L_PREFIX + "-rc-" +  deployment_id;
 
 # 각 mapper와 reducer와 coordinator의 lambda_handler 코드를 패키징하여 압축합니다.
+t_start = time.time()
 zipLambda(config["mapper"]["name"], config["mapper"]["zip"])
 zipLambda(config["reducer"]["name"], config["reducer"]["zip"])
 zipLambda(config["reducerCoordinator"]["name"], config["reducerCoordinator"]["zip"])
 
-# Mapper를 Lambda Function에 등록합니다.
-l_mapper = lambdautils.LambdaManager(lambda_client, s3_client, region, config["mapper"]["zip"], job_id,
-        mapper_lambda_name, config["mapper"]["handler"])
-l_mapper.update_code_or_create_on_noexist()
+# Mapper를 Lambda Function에 등록합니다. (코드가 바뀌지 않았다면 재배포하지 않습니다.)
+l_mapper = lambdautils.LambdaManager(lambda_client, s3_client, region, config["mapper"]["zip"], deployment_id,
+        mapper_lambda_name, config["mapper"]["handler"], layers=config["mapper"].get("layers"))
+l_mapper.update_code_or_create_on_noexist(args.deploy)
+if async_mappers:
+    l_mapper.set_event_invoke_config(max_event_age, ASYNC_RETRY_ATTEMPTS)
 
 # Reducer를 Lambda Function에 등록합니다.
-l_reducer = lambdautils.LambdaManager(lambda_client, s3_client, region, config["reducer"]["zip"], job_id,
+l_reducer = lambdautils.LambdaManager(lambda_client, s3_client, region, config["reducer"]["zip"], deployment_id,
         reducer_lambda_name, config["reducer"]["handler"])
-l_reducer.update_code_or_create_on_noexist()
+l_reducer.update_code_or_create_on_noexist(args.deploy)
 
 # Coordinator를 Lambda Function에 등록합니다.
-l_rc = lambdautils.LambdaManager(lambda_client, s3_client, region, config["reducerCoordinator"]["zip"], job_id,
+l_rc = lambdautils.LambdaManager(lambda_client, s3_client, region, config["reducerCoordinator"]["zip"], deployment_id,
         rc_lambda_name, config["reducerCoordinator"]["handler"])
-l_rc.update_code_or_create_on_noexist()
+l_rc.update_code_or_create_on_noexist(args.deploy)
 
-# Coordinator에 작업을 할 Bucket에 대한 권한(permission)을 부여합니다.
-l_rc.add_lambda_permission(random.randint(1,1000), job_bucket)
+# Coordinator에 작업을 할 Bucket에 대한 권한(permission)을 부여합니다. (이미 있다면 그대로 사용)
+l_rc.add_lambda_permission(rc_lambda_name + "-" + job_bucket.replace(".", "-"), job_bucket)
 
 # Coordinator에 작업을 할 Bucket에 대한 알림(notification)을 부여합니다.
-l_rc.create_s3_eventsource_notification(job_bucket)
+# 모든 job의 task 출력(<deploymentId>/task/)만 구독하므로 동시에 실행되는 job이 같은 설정을 공유하고,
+# jobdata, reducerstate, stats 등 다른 파일의 쓰기는 coordinator를 호출하지 않습니다.
+l_rc.create_s3_eventsource_notification(job_bucket, deployment_id + "/task/")
+
+trace_span("deploy", t_start)
 
-# 실행 중인 job에 대한 정보를 json 으로 S3에 저장
+# 실행 중인 job의 manifest를 S3에 저장합니다.
+# Coordinator는 이 manifest에서 job 파라미터를 읽습니다.
+t_start = time.time()
 j_key = job_id + "/jobdata"
 data = json.dumps({
-                "mapCount": n_mappers, 
-                "totalS3Files": len(all_keys),
+                "jobId": job_id,
+                "jobBucket": job_bucket,
+                "mapCount": map_count, 
+                "reducerFunction": reducer_lambda_name,
+                "reducerHandler": config["reducer"]["handler"],
+                "retainIntermediate": config.get("retainIntermediate", False),
+                "memoryBudgetMB": config.get("aggregationMemoryMB"),
+                "aggregation": config.get("aggregation"),
+                "resultShards": result_shards if sharded_result else None,
+                "hashedKeys": config.get("hashedKeys", False),
+                "totalS3Files": len(input_keys),
                 "startTime": time.time()
                 })
 write_to_s3(job_bucket, j_key, data, {})
 
+# 이전 결과(merge 가능한 형식)를 마지막 mapper들의 출력으로 복사합니다.
+for i, prior_key in enumerate(prior_result_keys):
+    s3_client.copy_object(Bucket=job_bucket,
+                          Key=s3io.task_key(job_id, "mapper/", n_mappers + i + 1, config.get("hashedKeys", False)),
+                          CopySource={'Bucket': job_bucket, 'Key': prior_key})
+
+trace_span("write manifest", t_start)
+
 ######## MR 실행 ########
 
 mapper_outputs = []
 
 # 3. Invoke Mappers
-def invoke_lambda(batches, m_id):
+def invoke_lambda(payloads, m_id):
     '''
     Lambda 함수를 호출(invoke) 합니다.
     '''
 
-    batch = [k.key for k in batches[m_id-1]]
-
+    invoke_start = time.time()
     resp = lambda_client.invoke( 
             FunctionName = mapper_lambda_name,
-            InvocationType = 'RequestResponse',
-            Payload =  json.dumps({
-                "bucket": bucket,
-                "keys": batch,
-                "jobBucket": job_bucket,
-                "jobId": job_id,
-                "mapperId": m_id
-            })
+            InvocationType = invocation_type,
+            Payload = payloads[m_id-1]
         )
+    if trace is not None:
+        trace.add_invoke(m_id, invoke_start, time.time())
+    if async_mappers:
+        # 비동기 호출은 queue에 들어간 것만 확인합니다. (결과는 mapper 출력의 metadata에서 가져옵니다)
+        if resp['StatusCode'] != 202:
+            raise RuntimeError("mapper %s was not queued: %s" % (m_id, resp['StatusCode']))
+        return
     out = eval(resp['Payload'].read())
     mapper_outputs.append(out)
     print("mapper output", out)
 
 # 병렬 실행 Parallel Execution
 print("# of Mappers ", n_mappers)
-pool = ThreadPool(n_mappers)
+# 동기 호출은 mapper가 끝날 때까지 connection을 잡고 있으므로 mapper마다 thread가 필요합니다.
+pool = ThreadPool(min(dispatch_threads, n_mappers) if async_mappers else n_mappers)
 Ids = [i+1 for i in range(n_mappers)]
-invoke_lambda_partial = partial(invoke_lambda, batches)
+invoke_lambda_partial = partial(invoke_lambda, payloads)
 
 # Mapper의 개수 만큼 요청 Request Handling
 mappers_executed = 0
@@ -184,7 +382,13 @@ while mappers_executed < n_mappers:
 pool.close()
 pool.join()
 
-print("all the mappers finished ...")
+if async_mappers:
+    print("all the mappers were queued ...")
+    # 비동기 호출의 실패는 driver에 전달되지 않습니다. Lambda는 max_event_age가 지난 event를 실행하지 않으므로,
+    # 마지막 호출 후 max_event_age와 한 번의 실행 시간이 지나도 출력이 없다면 실패한 mapper 입니다.
+    mapper_deadline = time.time() + max_event_age + l_mapper.timeout
+else:
+    print("all the mappers finished ...")
 
 # Mapper Lambda function 삭제
 # l_mapper.delete_function()
@@ -198,46 +402,138 @@ total_s3_put_ops = 0
 s3_storage_hours = 0
 total_lines = 0
 
-for output in mapper_outputs:
-    total_s3_get_ops += int(output[0])
-    total_lines += int(output[1])
-    total_lambda_secs += float(output[2])
-
-mapper_lambda_time = total_lambda_secs
-
 #Note: Wait for the job to complete so that we can compute total cost ; create a poll every 10 secs
 
-# 모든 reducer의 keys를 가져옵니다.
-reducer_keys = []
-
 # Reducer의 전체 실행 시간을 가져옵니다.
 reducer_lambda_time = 0
 
+t_start = time.time()
 while True:
-    job_keys = s3_client.list_objects(Bucket=job_bucket, Prefix=job_id)["Contents"]
-    keys = [jk["Key"] for jk in job_keys]
-    total_s3_size = sum([jk["Size"] for jk in job_keys])
+    job_files = lambdautils.list_job_files(s3_client, job_bucket, job_id)
     
     print("check to see if the job is done")
 
     # check job done
-    if job_id + "/result" in keys:
+    if any(f["Key"] == job_id + "/result" for f in job_files):
         print("job done")
-        reducer_lambda_time += float(s3.Object(job_bucket, job_id + "/result").metadata['processingtime'])
-        for key in keys:
-            if "task/reducer" in key:
-                reducer_lambda_time += float(s3.Object(job_bucket, key).metadata['processingtime'])
-                reducer_keys.append(key)
         break
+
+    # 진행 상황: reducer step이 시작되기 전에는 mapper 출력 수, 이후에는 최신 reducerstate
+    steps = [int(f["Key"].rsplit('.', 1)[1]) for f in job_files if "/reducerstate." in f["Key"]]
+    if steps:
+        print("reducer step %s running" % max(steps))
+    else:
+        done = len([f for f in job_files if f["Key"].startswith(s3io.task_prefix(job_id) + "mapper/")])
+        print("mappers done %s/%s" % (done, map_count))
+        if async_mappers and time.time() > mapper_deadline:
+            # reducer가 시작되기 전에는 mapper 출력이 GC 되지 않으므로 없는 출력은 실패한 mapper 입니다.
+            existing = set(f["Key"] for f in job_files)
+            missing = [m_id for m_id in Ids if s3io.task_key(job_id, "mapper/", m_id,
+                                                             config.get("hashedKeys", False)) not in existing]
+            if missing:
+                print("mappers without output after all retries:", ", ".join(str(m_id) for m_id in missing))
+                sys.exit(1)
     time.sleep(5)
+job_end = time.time()
+trace_span("wait for result", t_start)
+
+# 중간 파일은 reduce 중에 GC 되므로, task 출력의 통계는 reducer가 남긴 stats 파일에서 가져옵니다.
+def read_stats(key):
+    return json.loads(s3_client.get_object(Bucket=job_bucket, Key=key)["Body"].read())
+
+stats_keys = [o["Key"] for page in s3_client.get_paginator('list_objects_v2').paginate(
+                  Bucket=job_bucket, Prefix=job_id + "/stats/") for o in page.get("Contents", [])]
+task_stats = {}
+coordinator_states = {}
+stats_pool = ThreadPool(32)
+for key, stats in zip(stats_keys, stats_pool.map(read_stats, stats_keys)):
+    task_stats.update(stats["inputs"])
+    if stats.get("coordinator"):
+        coordinator_states[int(key.split("/stats/")[1].split("/")[0])] = stats["coordinator"]
+stats_pool.close()
+
+# 비동기 호출은 반환값이 없으므로 mapper 출력의 metadata로 mapper 통계를 만듭니다.
+# (incremental job에 복사된 이전 결과는 mapper id가 n_mappers보다 큽니다)
+if async_mappers:
+    for key, st in task_stats.items():
+        parsed = jobtrace.parse_task_key(key)
+        if parsed is not None and parsed[0] == 0 and parsed[1] <= n_mappers:
+            md = st["metadata"]
+            mapper_outputs.append([md["inputcount"], md["linecount"], md["processingtime"]])
+
+for output in mapper_outputs:
+    total_s3_get_ops += int(output[0])
+    total_lines += int(output[1])
+    total_lambda_secs += float(output[2])
+
+mapper_lambda_time = total_lambda_secs
+
+result_obj = s3.Object(job_bucket, job_id + "/result")
+task_stats[job_id + "/result"] = {
+    "metadata": result_obj.metadata,
+    "lastModified": result_obj.last_modified.timestamp(),
+    "size": result_obj.content_length
+}
+
+# 모든 reducer의 keys를 가져옵니다.
+reducer_keys = [k for k in task_stats if k.startswith(s3io.task_prefix(job_id) + "reducer/")]
+for key in reducer_keys + [job_id + "/result"]:
+    reducer_lambda_time += float(task_stats[key]["metadata"]["processingtime"])
+total_s3_size = sum(st["size"] for st in task_stats.values())
+# 이 job이 S3에 쓴 object 수 (task 출력, stats, reducerstate, manifest)
+n_job_objects = len(task_stats) + len(stats_keys) + len(coordinator_states) + 1
+if sharded_result:
+    # result는 shard 목록이므로 각 shard의 크기와 수를 더합니다.
+    result_shard_list = read_result_shards(job_bucket, job_id + "/result")
+    total_s3_size += sum(shard["size"] for shard in result_shard_list)
+    n_job_objects += len(result_shard_list)
+    print("Result shards:", ", ".join(shard["key"] for shard in result_shard_list))
+
+# Job의 timeline을 Chrome trace로 저장하고 critical path를 출력합니다.
+if trace is not None:
+    for key, st in task_stats.items():
+        trace.add_task(key, st["metadata"], st["lastModified"])
+    for step, state in coordinator_states.items():
+        trace.add_coordinator(step, state)
+
+    trace.export(args.trace)
+    print("Trace written to", args.trace)
+    print("Critical path:")
+    for category, secs in sorted(trace.critical_path_summary().items(), key=lambda kv: kv[1], reverse=True):
+        print("  %-30s %8.3f s" % (category, secs))
+
+# 통계를 모두 읽었으므로 reducer의 stats 파일과 job manifest를 제거합니다. (retainIntermediate: 디버깅을 위해 보존)
+if not config.get("retainIntermediate", False):
+    print("Deleted job stats and manifest", lambdautils.delete_keys(s3_client, job_bucket, stats_keys + [j_key]))
+
+# Incremental job의 상태(처리한 입력과 merge 가능한 결과의 위치)를 저장합니다.
+if args.incremental:
+    processed = dict(inc_state["inputs"]) if prior_result_keys else {}
+    processed.update((obj.key, obj.e_tag) for obj in input_keys)
+    result_key = job_id + ("/state" if sketches.is_sketch(config.get("aggregation")) else "/result")
+    write_to_s3(job_bucket, inc_state_key, json.dumps({
+        "jobId": job_id,
+        "bucket": bucket,
+        "prefix": config["prefix"],
+        "aggregation": config.get("aggregation"),
+        "broadcast": config.get("broadcast"),
+        "broadcastEtag": broadcast_spec["etag"] if broadcast_spec else None,
+        "inputFormat": input_format,
+        "columns": config.get("columns"),
+        "filters": config.get("filters"),
+        "resultKey": result_key,
+        "resultSharded": sharded_result,
+        "inputs": processed
+        }), {})
+    print("Saved incremental state", inc_state_key)
 
 # S3 Storage 비용 - mapper만 계산합니다.
 # 비용은 3 cents/GB/month
 s3_storage_hour_cost = 1 * 0.0000521574022522109 * (total_s3_size/1024.0/1024.0/1024.0) # cost per GB/hr 
 
-s3_put_cost = len(job_keys) *  0.005/1000 # PUT, COPY, POST, LIST 요청 비용 Request 0.005 USD / request 1000
+s3_put_cost = n_job_objects *  0.005/1000 # PUT, COPY, POST, LIST 요청 비용 Request 0.005 USD / request 1000
 
-total_s3_get_ops += len(job_keys) 
+total_s3_get_ops += n_job_objects
 s3_get_cost = total_s3_get_ops * 0.004/10000  # GET, SELECT, etc 요청 비용 Request 0.0004 USD / request 1000
 
 # 전체 Lambda 비용 계산
@@ -256,7 +552,7 @@ print("S3 Storage Cost", s3_storage_hour_cost)
 print("S3 Request Cost", s3_get_cost + s3_put_cost )
 print("S3 Cost", s3_cost )
 print("Total Cost: ", lambda_cost + s3_cost)
-print("Total Latency: ", total_lambda_secs) 
+print("Total Latency: ", job_end - driver_start)
 print("Result Output Lines:", total_lines)
 
 # Reducer Lambda function 삭제
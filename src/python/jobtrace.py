@@ -0,0 +1,229 @@
+'''
+Job timeline trace export and critical-path analysis
+
+* Copyright 2016, Amazon.com, Inc. or its affiliates. All Rights Reserved.
+*
+* Licensed under the Amazon Software License (the "License").
+* You may not use this file except in compliance with the License.
+* A copy of the License is located at
+*
+* http://aws.amazon.com/asl/
+*
+* or in the "license" file accompanying this file. This file is distributed
+* on an "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either
+* express or implied. See the License for the specific language governing
+* permissions and limitations under the License.
+'''
+
+import json
+import re
+
+# Chrome trace (chrome://tracing, https://ui.perfetto.dev)의 process 구분
+DRIVER_PID = 1
+MAPPER_PID = 2
+COORDINATOR_PID = 3
+REDUCER_PID = 10  # + step 번호
+CRITICAL_PATH_PID = 100
+
+# hashedKeys 설정 시 task id 앞에 hash prefix(<hh>/)가 추가됩니다.
+TASK_KEY_RE = re.compile(r'/(mapper)/(?:[0-9a-f]{2}/)?(\d+)$|/reducer/(\d+)/(?:[0-9a-f]{2}/)?(\d+)$|/(result)$')
+
+
+def parse_task_key(key):
+    '''
+    task 출력 key를 (step, id)로 변환합니다. mapper는 step 0, 최종 result는 step None 입니다.
+    '''
+    m = TASK_KEY_RE.search(key)
+    if m is None:
+        return None
+    if m.group(1):
+        return 0, int(m.group(2))
+    if m.group(3):
+        return int(m.group(3)), int(m.group(4))
+    return None, 0
+
+
+class JobTrace(object):
+    '''
+    driver, mapper, coordinator, reducer의 시작/종료 시간을 모아
+    Chrome trace JSON으로 내보내고 job의 critical path를 계산합니다.
+    '''
+
+    def __init__(self, job_id, start_time):
+        self.job_id = job_id
+        self.start_time = start_time
+        self.driver_spans = []   # (name, start, end)
+        self.invokes = {}        # mapper id -> (driver invoke start, end)
+        self.tasks = {}          # task key -> {"step", "id", "start", "end", "written", "args"}
+        self.coordinators = {}   # step -> reducerstate 내용
+
+    def add_driver_span(self, name, start, end):
+        self.driver_spans.append((name, start, end))
+
+    def add_invoke(self, mapper_id, start, end):
+        self.invokes[mapper_id] = (start, end)
+
+    def add_task(self, key, metadata, last_modified):
+        '''
+        mapper/reducer 출력 object의 metadata(starttime, endtime)와 LastModified(epoch)를 추가합니다.
+        '''
+        parsed = parse_task_key(key)
+        if parsed is None or 'starttime' not in metadata:
+            return
+        step, task_id = parsed
+        start = float(metadata['starttime'])
+        if start < self.start_time:
+            # incremental job에 복사된 이전 job의 결과
+            return
+        end = float(metadata.get('endtime', start + float(metadata.get('processingtime', 0))))
+        self.tasks[key] = {
+            "step": step,
+            "id": task_id,
+            "start": start,
+            "end": end,
+            "written": max(end, last_modified),
+            "args": metadata
+        }
+
+    def add_coordinator(self, step, state):
+        self.coordinators[step] = state
+
+    def _written(self, key):
+        '''
+        task 출력의 write 종료 시간. coordinator를 trigger한 object는 S3 event의 eventTime(정확한 생성 시간)을,
+        나머지는 LastModified(초 단위 근사값)를 사용합니다.
+        '''
+        task = self.tasks[key]
+        for state in self.coordinators.values():
+            if state.get("triggerKey") == key and state.get("triggerTime") is not None:
+                return max(task["end"], float(state["triggerTime"]))
+        return task["written"]
+
+    def _final_step(self):
+        if self.coordinators:
+            return max(self.coordinators)
+        steps = [t["step"] for t in self.tasks.values() if t["step"]]
+        return max(steps) + 1 if steps else 1
+
+    def _step_of(self, task):
+        return self._final_step() if task["step"] is None else task["step"]
+
+    def _us(self, ts):
+        return int(round((ts - self.start_time) * 1e6))
+
+    def _span(self, name, cat, start, end, pid, tid, args=None):
+        return {
+            "name": name, "cat": cat, "ph": "X",
+            "ts": self._us(start), "dur": max(0, self._us(end) - self._us(start)),
+            "pid": pid, "tid": tid, "args": args or {}
+        }
+
+    def _process_name(self, pid, name):
+        return {"name": "process_name", "ph": "M", "pid": pid, "tid": 0, "args": {"name": name}}
+
+    def to_chrome_trace(self):
+        events = [self._process_name(DRIVER_PID, "driver"),
+                  self._process_name(MAPPER_PID, "mappers"),
+                  self._process_name(COORDINATOR_PID, "reducer coordinator"),
+                  self._process_name(CRITICAL_PATH_PID, "critical path")]
+
+        for name, start, end in self.driver_spans:
+            events.append(self._span(name, "driver", start, end, DRIVER_PID, 0))
+        for mapper_id, (start, end) in sorted(self.invokes.items()):
+            events.append(self._span("invoke mapper %s" % mapper_id, "driver", start, end, DRIVER_PID, mapper_id))
+
+        steps = set()
+        for key, task in sorted(self.tasks.items()):
+            step = self._step_of(task)
+            if task["step"] == 0:
+                pid, name = MAPPER_PID, "mapper %s" % task["id"]
+            else:
+                pid, name = REDUCER_PID + step, "reducer %s/%s" % (step, task["id"])
+                steps.add(step)
+            events.append(self._span(name, "task", task["start"], task["end"], pid, task["id"], task["args"]))
+            events.append(self._span("s3 write", "s3", task["end"], self._written(key), pid, task["id"], {"key": key}))
+        for step in sorted(steps):
+            events.append(self._process_name(REDUCER_PID + step, "reducer step %s" % step))
+
+        for step, state in sorted(self.coordinators.items()):
+            start = state.get("coordinatorStart")
+            if start is None:
+                continue
+            # coordinator가 reducer를 호출한 후 처음 reducer가 시작된 시점까지
+            starts = [t["start"] for t in self.tasks.values() if t["step"] is not None and t["step"] == step]
+            if self._final_step() == step:
+                starts += [t["start"] for t in self.tasks.values() if t["step"] is None]
+            end = min(starts) if starts else start
+            events.append(self._span("start reducer step %s" % step, "coordinator", start,
+                                     end, COORDINATOR_PID, step, state))
+
+        for category, start, end in self.critical_path():
+            events.append(self._span(category, "critical path", start, end, CRITICAL_PATH_PID, 0))
+
+        return {"traceEvents": events, "displayTimeUnit": "ms",
+                "otherData": {"jobId": self.job_id}}
+
+    def export(self, fname):
+        with open(fname, 'w') as f:
+            json.dump(self.to_chrome_trace(), f)
+
+    def critical_path(self):
+        '''
+        최종 result에서 거꾸로 (reducer <- coordinator <- 가장 늦게 끝난 입력 task <- ... <- mapper <- driver)
+        의존 관계를 따라가며 (category, start, end) segment 목록을 시간 순서로 반환합니다.
+        '''
+        path = []
+        cur_key = self.job_id + "/result"
+        while cur_key in self.tasks:
+            task = self.tasks[cur_key]
+            step = self._step_of(task)
+            path.append(("s3 write", task["end"], self._written(cur_key)))
+            if task["step"] == 0:
+                path.append(("mapper", task["start"], task["end"]))
+                invoke = self.invokes.get(task["id"])
+                if invoke is None:
+                    break
+                path.append(("mapper invoke", invoke[0], task["start"]))
+                # driver의 listing/deploy 등 mapper 호출 이전 단계
+                cursor = invoke[0]
+                for name, start, end in sorted(self.driver_spans, key=lambda s: s[2], reverse=True):
+                    if end > cursor:
+                        continue
+                    if end < cursor:
+                        path.append(("mapper dispatch" if cursor == invoke[0] else "driver", end, cursor))
+                    path.append((name, start, end))
+                    cursor = start
+                break
+
+            path.append(("reducer step %s" % step, task["start"], task["end"]))
+            state = self.coordinators.get(step)
+            if state is None or state.get("coordinatorStart") is None:
+                break
+            coord_start = float(state["coordinatorStart"])
+            path.append(("coordinator + reducer invoke", coord_start, task["start"]))
+            # step의 입력 중 가장 늦게 쓰여진 object가 coordinator가 step을 시작할 수 있었던 시점을 결정합니다.
+            inputs = [key for key, t in self.tasks.items() if t["step"] == step - 1]
+            if not inputs:
+                break
+            cur_key = max(inputs, key=self._written)
+            path.append(("notification lag", self._written(cur_key), coord_start))
+
+        # path는 늦은 segment부터 쌓였습니다. 시계 오차와 LastModified의 초 단위 값 때문에 겹치는 구간을 잘라냅니다.
+        clamped = []
+        later_start = None
+        for category, start, end in path:
+            if later_start is not None:
+                end = min(end, later_start)
+            start = min(start, end)
+            clamped.append((category, start, end))
+            later_start = start
+        return list(reversed(clamped))
+
+    def critical_path_summary(self):
+        '''
+        critical path의 category별 시간(초)을 반환합니다.
+        '''
+        summary = {}
+        for category, start, end in self.critical_path():
+            summary[category] = summary.get(category, 0.0) + (end - start)
+        return summary
@@ -14,13 +14,16 @@
  * permissions and limitations under the License. 
 '''
 
+import base64
 import boto3
 import botocore
+import hashlib
 import os
+import s3io
 
 
 class LambdaManager(object):
-    def __init__(self, l, s3, region, codepath, job_id, fname, handler, lmem=1024):
+    def __init__(self, l, s3, region, codepath, job_id, fname, handler, lmem=1024, layers=None):
         self.awslambda = l
         self.region = "us-east-1" if region is None else region
         self.s3 = s3
@@ -31,6 +34,7 @@ class LambdaManager(object):
         self.role = os.environ.get('serverless_mapreduce_role')
         self.memory = lmem
         self.timeout = 900
+        self.layers = layers or []  # 추가 라이브러리 (예: parquet 입력을 위한 pyarrow layer)
         self.function_arn = None  # Lambda Function이 생성된 후에 설정됩니다.
 
     def create_lambda_function(self):
@@ -48,7 +52,8 @@ class LambdaManager(object):
             Runtime=runtime,
             Description=self.function_name,
             MemorySize=self.memory,
-            Timeout=self.timeout
+            Timeout=self.timeout,
+            Layers=self.layers
         )
         self.function_arn = response['FunctionArn']
         print(response)
@@ -68,59 +73,104 @@ class LambdaManager(object):
         self.function_arn = arn
         print(response)
 
-    def update_code_or_create_on_noexist(self):
+    def code_sha256(self):
+        '''
+        패키징한 zip 파일의 CodeSha256 (Lambda가 반환하는 형식, base64)을 계산합니다.
+        '''
+        with open(self.codefile, 'rb') as f:
+            return base64.b64encode(hashlib.sha256(f.read()).digest()).decode()
+
+    def update_code_or_create_on_noexist(self, force=False):
         '''
         AWS Lambda Functions가 존재한다면 업데이트를 하고, 없다면 생성합니다.
+        배포된 코드가 로컬 zip 파일과 같다면 재배포하지 않습니다. (force=True 이면 항상 업데이트)
         '''
         try:
             self.create_lambda_function()
+            return True
         except botocore.exceptions.ClientError as e:
             # parse (Function already exist) 
-            self.update_function()
+            pass
+
+        deployed = self.awslambda.get_function(FunctionName=self.function_name)['Configuration']
+        deployed_layers = [layer['Arn'] for layer in deployed.get('Layers', [])]
+        if self.layers and deployed_layers != self.layers:
+            self.awslambda.update_function_configuration(FunctionName=self.function_name, Layers=self.layers)
+            self.awslambda.get_waiter('function_updated').wait(FunctionName=self.function_name)
+        if not force and deployed['CodeSha256'] == self.code_sha256():
+            self.function_arn = deployed['FunctionArn']
+            print("Lambda function is up to date", self.function_name)
+            return False
+
+        self.update_function()
+        return True
+
+    def set_event_invoke_config(self, max_event_age, max_retry_attempts):
+        '''
+        비동기(Event) 호출의 최대 대기 시간(초)과 재시도 횟수를 설정합니다.
+        이 시간이 지나도록 실행되지 못한 event는 Lambda가 버립니다.
+        '''
+        self.awslambda.put_function_event_invoke_config(
+            FunctionName=self.function_name,
+            MaximumEventAgeInSeconds=max_event_age,
+            MaximumRetryAttempts=max_retry_attempts
+        )
 
     def add_lambda_permission(self, sId, bucket):
         '''
         AWS Lambda의 권한(permission)을 설정합니다.
         S3 Bucket에서 이벤트시에 AWS Lambda를 Trigger 합니다.
+        같은 StatementId의 권한이 이미 있다면 그대로 사용합니다.
         '''
-        resp = self.awslambda.add_permission(
-            Action='lambda:InvokeFunction',
-            FunctionName=self.function_name,
-            Principal='s3.amazonaws.com',
-            StatementId='%s' % sId,
-            SourceArn='arn:aws:s3:::' + bucket
-        )
-        print(resp)
+        try:
+            resp = self.awslambda.add_permission(
+                Action='lambda:InvokeFunction',
+                FunctionName=self.function_name,
+                Principal='s3.amazonaws.com',
+                StatementId='%s' % sId,
+                SourceArn='arn:aws:s3:::' + bucket
+            )
+            print(resp)
+        except botocore.exceptions.ClientError as e:
+            if e.response['Error']['Code'] != 'ResourceConflictException':
+                raise
 
     def create_s3_eventsource_notification(self, bucket, prefix=None):
         '''
         S3에서 발생하는 이벤트(Object 생성)를 Lambda function으로 알림(notifincation) 설정합니다.
+        Bucket의 기존 알림 설정은 유지하고, 이 function의 설정만 추가/교체합니다.
+        (Id가 다르더라도 이 function을 호출하는 이전 설정은 prefix가 겹치므로 제거합니다.)
         '''
         if not prefix:
             prefix = self.job_id + "/task";
 
+        current = self.s3.get_bucket_notification_configuration(Bucket=bucket)
+        current.pop('ResponseMetadata', None)
+
+        config_id = self.function_name
+        function_arn = unqualified_arn(self.function_arn)
+        lambda_configs = [c for c in current.get('LambdaFunctionConfigurations', [])
+                          if c.get('Id') != config_id and unqualified_arn(c['LambdaFunctionArn']) != function_arn]
+        lambda_configs.append({
+            'Id': config_id,
+            'Events': ['s3:ObjectCreated:*'],
+            'LambdaFunctionArn': self.function_arn,
+            'Filter': {
+                'Key': {
+                    'FilterRules': [
+                        {
+                            'Name': 'prefix',
+                            'Value': prefix
+                        },
+                    ]
+                }
+            }
+        })
+        current['LambdaFunctionConfigurations'] = lambda_configs
+
         self.s3.put_bucket_notification_configuration(
             Bucket=bucket,
-            NotificationConfiguration={
-                'LambdaFunctionConfigurations': [
-                    {
-                        'Events': ['s3:ObjectCreated:*'],
-                        'LambdaFunctionArn': self.function_arn,
-                        'Filter': {
-                            'Key': {
-                                'FilterRules': [
-                                    {
-                                        'Name': 'prefix',
-                                        'Value': prefix
-                                    },
-                                ]
-                            }
-                        }
-                    }
-                ],
-                # 'TopicConfigurations' : [],
-                # 'QueueConfigurations' : []
-            }
+            NotificationConfiguration=current
         )
 
     def delete_function(self):
@@ -139,6 +189,14 @@ class LambdaManager(object):
         return response
 
 
+def unqualified_arn(function_arn):
+    '''
+    Lambda function ARN에서 version/alias 접미사를 제거합니다.
+    arn:aws:lambda:<region>:<account>:function:<name>[:<qualifier>]
+    '''
+    return ':'.join(function_arn.split(':')[:7])
+
+
 def compute_batch_size(keys, lambda_memory, concurrent_lambdas):
     '''
     Lambda의 메모리 크기와 동시 실행 수를 고려하여 batch size 계산합니다.
@@ -179,3 +237,31 @@ def batch_creator(all_keys, batch_size):
     if len(batch):
         batches.append(batch)
     return batches
+
+
+def list_job_files(s3_client, bucket, job_id):
+    '''
+    Job의 파일 목록을 가져옵니다. (<jobId>/ 바로 아래의 파일과 job의 task 출력)
+    stats/ 등 다른 하위 prefix는 제외하며, 1000개가 넘는 key는 paginator로 모두 가져옵니다.
+    '''
+    paginator = s3_client.get_paginator('list_objects_v2')
+    files = []
+    for params in ({'Prefix': job_id + "/", 'Delimiter': "/"}, {'Prefix': s3io.task_prefix(job_id)}):
+        for page in paginator.paginate(Bucket=bucket, **params):
+            files.extend(page.get('Contents', []))
+    return files
+
+
+def delete_keys(s3_client, bucket, keys):
+    '''
+    여러 object를 multi-object delete (요청당 최대 1000개)로 제거합니다.
+    '''
+    keys = list(keys)
+    for i in range(0, len(keys), 1000):
+        response = s3_client.delete_objects(
+            Bucket=bucket,
+            Delete={'Objects': [{'Key': k} for k in keys[i:i + 1000]], 'Quiet': True}
+        )
+        for err in response.get('Errors', []):
+            print("Delete failed", err)
+    return len(keys)
@@ -15,24 +15,27 @@ Python mapper function
 * permissions and limitations under the License. 
 '''
 
-import boto3
+import aggregator
+import broadcast
+import columnar
 import json
 import random
 import resource
+import s3io
+import sketches
 from io import StringIO
 import time
 
-# S3 session 생성
-s3 = boto3.resource('s3')
-s3_client = boto3.client('s3')
+# S3 session 생성 (rate limiting과 SlowDown 재시도를 하는 공용 S3 layer)
+s3_client = s3io.client()
 
 # Mapper의 결과가 작성될 S3 Bucket 위치
-TASK_MAPPER_PREFIX = "task/mapper/"
+TASK_MAPPER_PREFIX = "mapper/"
 
 
 # 주어진 bucket 위치 경로에 파일 이름이 key인 object와 data를 저장합니다.
 def write_to_s3(bucket, key, data, metadata):
-    s3.Bucket(bucket).put_object(Key=key, Body=data, Metadata=metadata)
+    s3_client.put_object(Bucket=bucket, Key=key, Body=data, Metadata=metadata)
 
 
 def lambda_handler(event, context):
@@ -44,41 +47,102 @@ def lambda_handler(event, context):
     job_id = event['jobId']
     mapper_id = event['mapperId']
 
-    output = {}
+    # sketch 모드(distinct, topk)에서는 고정된 크기의 mergeable 상태를 출력합니다.
+    agg_spec = event.get('aggregation') or {}
+    sketch = sketches.create(agg_spec) if sketches.is_sketch(agg_spec) else None
+
+    # key 개수에 상관없이 고정된 메모리 안에서 집계합니다. (초과 시 /tmp로 spill)
+    output = aggregator.AggregationTable(
+        aggregator.memory_budget_bytes(event.get('memoryBudgetMB'), context))
     line_count = 0
+    bytes_read = 0
     err = ''
 
-    # 입력 CSV => 츌력 JSON 포멧
-
-    # 모든 key를 다운로드하고 Map을 처리합니다.
-    for key in src_keys:
-        response = s3_client.get_object(Bucket=src_bucket, Key=key)
-        contents = response['Body'].read()
-        # Map Function
-        for line in contents.decode().split('\n')[:-1]:
-            line_count += 1
-            try:
-                data = line.split(',')
-                print('data: ', data)
-                srcIp = data[0][:8]
-                if srcIp not in output:
-                    output[srcIp] = 0
-                output[srcIp] += float(data[3])
-            except Exception as e:
-                print(e)
+    # broadcast join: side table에서 join column의 값을 찾아 그 값으로 group by 합니다.
+    join_spec = event.get('broadcast')
+    join_table = broadcast.load_table(s3_client, join_spec) if join_spec else None
+    join_misses = 0
+
+    def emit(src_ip, revenue, join_key=None):
+        nonlocal join_misses
+        if join_table is not None:
+            group = join_table.get(join_key)
+            if group is None:
+                # inner join - side table에 없는 row는 제외합니다.
+                join_misses += 1
+                return
+        elif sketch is not None:
+            # sketch 모드에서는 전체 sourceIP를 key로 사용합니다.
+            group = src_ip
+        else:
+            group = src_ip[:8]
+        if sketch is not None:
+            sketch.update(group, revenue)
+        else:
+            output.add(group, revenue)
+
+    if event.get('inputFormat', columnar.CSV) == columnar.PARQUET:
+        # 입력 Parquet => 필요한 column chunk만 ranged read 합니다. (keys는 row group 단위의 split)
+        columns = list(event['columns'])
+        if join_table is not None:
+            columns.append(join_spec["joinColumn"])
+        reader = columnar.ParquetReader(s3_client, src_bucket, columns, event.get('filters'))
+        for split in src_keys:
+            for row in reader.read_split(split):
+                line_count += 1
+                # null 값이 있는 row는 CSV의 빈 값처럼 건너뜁니다.
+                if row[0] is None or row[1] is None:
+                    continue
+                try:
+                    join_key = row[2] if join_table is not None else None
+                    emit(str(row[0]), float(row[1]), None if join_key is None else str(join_key))
+                except Exception as e:
+                    print(e)
+        reader.close()
+        bytes_read = reader.bytes_read
+        print("Skipped row groups", reader.skipped_row_groups)
+    else:
+        # 입력 CSV => 츌력 JSON 포멧
+
+        # 모든 key를 다운로드하고 Map을 처리합니다.
+        for key in src_keys:
+            response = s3_client.get_object(Bucket=src_bucket, Key=key)
+            contents = response['Body'].read()
+            bytes_read += len(contents)
+            # Map Function
+            for line in contents.decode().split('\n')[:-1]:
+                line_count += 1
+                try:
+                    data = line.split(',')
+                    print('data: ', data)
+                    emit(data[0], float(data[3]),
+                         data[join_spec["joinColumn"]] if join_table is not None else None)
+                except Exception as e:
+                    print(e)
 
     time_in_secs = (time.time() - start_time)
 
     # Mapper의 결과를 전처리, 이후에 S3에 저장
     pret = [len(src_keys), line_count, time_in_secs, err]
-    mapper_fname = "%s/%s%s" % (job_id, TASK_MAPPER_PREFIX, mapper_id)
+    mapper_fname = s3io.task_key(job_id, TASK_MAPPER_PREFIX, mapper_id, event.get('hashedKeys', False))
     metadata = {
+        "inputcount": '%s' % len(src_keys),
         "linecount": '%s' % line_count,
         "processingtime": '%s' % time_in_secs,
-        "memoryUsage": '%s' % resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        "starttime": '%s' % start_time,
+        "endtime": '%s' % time.time(),
+        "memoryUsage": '%s' % resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+        "spills": '%s' % len(output.runs),
+        "bytesread": '%s' % bytes_read,
+        "joinmisses": '%s' % join_misses
     }
     print("metadata", metadata)
 
     # 이 부분을 efs로 변경 시도 해야 할 듯 함.
-    write_to_s3(job_bucket, mapper_fname, json.dumps(output), metadata)
+    if sketch is not None:
+        write_to_s3(job_bucket, mapper_fname, sketch.to_bytes(), metadata)
+    else:
+        # 결과 문자열을 만들지 않고 직렬화하면서 S3로 스트리밍합니다.
+        aggregator.write_items_to_s3(s3_client, job_bucket, mapper_fname, output.items(), metadata)
+    output.close()
     return pret
@@ -16,25 +16,31 @@ Python reducer function
 
 '''
 
-import boto3
+import aggregator
 import json
+import lambdautils
 import random
 import resource
+import s3io
+import sketches
 import time
 
-# S3 session 생성
-s3 = boto3.resource('s3')
-s3_client = boto3.client('s3')
+# S3 session 생성 (rate limiting과 SlowDown 재시도를 하는 공용 S3 layer)
+s3_client = s3io.client()
 
 # Mapper의 결과가 저장된 S3 Bucket
-TASK_MAPPER_PREFIX = "task/mapper/"
+TASK_MAPPER_PREFIX = "mapper/"
 # Reducer의 결과를 저장할 S3 Bucket
-TASK_REDUCER_PREFIX = "task/reducer/"
+TASK_REDUCER_PREFIX = "reducer/"
+# 입력 파일의 통계(metadata)를 저장할 위치. 중간 파일이 GC 된 후에도 driver가 통계를 모을 수 있습니다.
+TASK_STATS_PREFIX = "stats/"
+# resultShards를 지정하면 최종 결과를 shard로 나누어 저장할 위치
+RESULT_SHARD_PREFIX = "result-parts/"
 
 
 # 주어진 bucket 위치 경로에 파일 이름이 key인 object와 data를 저장합니다.
 def write_to_s3(bucket, key, data, metadata):
-    s3.Bucket(bucket).put_object(Key=key, Body=data, Metadata=metadata)
+    s3_client.put_object(Bucket=bucket, Key=key, Body=data, Metadata=metadata)
 
 
 def lambda_handler(event, context):
@@ -48,8 +54,15 @@ def lambda_handler(event, context):
     step_id = event['stepId']
     n_reducers = event['nReducers']
 
-    results = {}
+    # sketch 모드에서는 mapper의 고정 크기 상태를 merge 합니다.
+    agg_spec = event.get('aggregation') or {}
+    sketch = None
+    result_shards = int(event.get('resultShards') or 1)
+
+    results = aggregator.AggregationTable(
+        aggregator.memory_budget_bytes(event.get('memoryBudgetMB'), context))
     line_count = 0
+    input_stats = {}
 
     # 입력 CSV => 츌력 JSON 포멧
 
@@ -59,13 +72,22 @@ def lambda_handler(event, context):
     for key in reducer_keys:
         response = s3_client.get_object(Bucket=job_bucket, Key=key)
         contents = response['Body'].read()
+        input_stats[key] = {
+            "metadata": response['Metadata'],
+            "lastModified": response['LastModified'].timestamp(),
+            "size": response['ContentLength']
+        }
+
+        if sketches.is_sketch(agg_spec):
+            line_count += 1
+            state = sketches.load(contents)
+            sketch = state if sketch is None else sketch.merge(state)
+            continue
 
         try:
             for srcIp, val in json.loads(contents).items():
                 line_count += 1
-                if srcIp not in results:
-                    results[srcIp] = 0
-                results[srcIp] += float(val)
+                results.add(srcIp, float(val))
         except Exception as e:
             print(e)
 
@@ -78,13 +100,49 @@ def lambda_handler(event, context):
         fname = "%s/result" % job_id
     else:
         # 중간 Reduce 단계의 저장
-        fname = "%s/%s%s/%s" % (job_id, TASK_REDUCER_PREFIX, step_id, r_id)
+        fname = s3io.task_key(job_id, "%s%s/" % (TASK_REDUCER_PREFIX, step_id), r_id, event.get('hashedKeys', False))
 
     metadata = {
         "linecount": '%s' % line_count,
         "processingtime": '%s' % time_in_secs,
-        "memoryUsage": '%s' % resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        "starttime": '%s' % start_time,
+        "endtime": '%s' % time.time(),
+        "memoryUsage": '%s' % resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+        "spills": '%s' % len(results.runs)
     }
 
-    write_to_s3(job_bucket, fname, json.dumps(results), metadata)
+    # 입력의 통계와 이 step을 시작한 coordinator의 정보를 저장합니다. (출력보다 먼저)
+    stats_fname = "%s/%s%s/%s" % (job_id, TASK_STATS_PREFIX, step_id, r_id)
+    write_to_s3(job_bucket, stats_fname, json.dumps({
+        "coordinator": event.get('coordinator'),
+        "inputs": input_stats
+    }), {})
+
+    if sketches.is_sketch(agg_spec):
+        if sketch is None:
+            sketch = sketches.create(agg_spec)
+        if n_reducers == 1:
+            # 마지막 단계에서는 추정값을 JSON으로 저장합니다.
+            # 다음 incremental job이 merge할 수 있도록 sketch 상태도 함께 저장합니다. (result보다 먼저)
+            write_to_s3(job_bucket, "%s/state" % job_id, sketch.to_bytes(), {})
+            write_to_s3(job_bucket, fname, json.dumps(sketch.result()), metadata)
+        else:
+            write_to_s3(job_bucket, fname, sketch.to_bytes(), metadata)
+    elif n_reducers == 1 and result_shards > 1:
+        # 최종 결과를 N개의 shard로 나누어 병렬로 업로드하고, 모든 shard가 저장된 후
+        # shard 목록(manifest)을 result로 저장합니다. (result는 job 완료 신호이므로 마지막에 저장)
+        shard_keys = ["%s/%s%s" % (job_id, RESULT_SHARD_PREFIX, i) for i in range(result_shards)]
+        sizes = aggregator.write_sharded_items_to_s3(s3_client, job_bucket, shard_keys, results.items(), metadata)
+        write_to_s3(job_bucket, fname, json.dumps({
+            "resultShards": [{"key": k, "size": size} for k, size in zip(shard_keys, sizes)]
+        }), metadata)
+    else:
+        # 결과 문자열을 만들지 않고 직렬화하면서 S3로 스트리밍합니다.
+        aggregator.write_items_to_s3(s3_client, job_bucket, fname, results.items(), metadata)
+    results.close()
+
+    if n_reducers == 1 and not event.get('retainIntermediate', False):
+        # 마지막 단계의 입력과 reducer 상태 파일은 더 이상 필요하지 않습니다.
+        lambdautils.delete_keys(s3_client, job_bucket,
+                                list(reducer_keys) + ["%s/reducerstate.%s" % (job_id, step_id)])
     return pret
@@ -16,12 +16,15 @@ REDUCER Coordinator
 '''
 
 import boto3
+import calendar
+import datetime
 import json
 import lambdautils
 import random
 import re
+import s3io
 import time
-import urllib
+import urllib.parse
 
 DEFAULT_REGION = "us-east-1"
 
@@ -29,34 +32,61 @@ DEFAULT_REGION = "us-east-1"
 MAPPERS_DONE = 0
 REDUCER_STEP = 1
 
-# S3 session 생성
-s3 = boto3.resource('s3')
-s3_client = boto3.client('s3')
+# S3 session 생성 (rate limiting과 SlowDown 재시도를 하는 공용 S3 layer)
+s3_client = s3io.client()
 # Lambda session 생성
 lambda_client = boto3.client('lambda')
 
 
 # 주어진 bucket 위치 경로에 파일 이름이 key인 object와 data를 저장합니다.
 def write_to_s3(bucket, key, data, metadata):
-    s3.Bucket(bucket).put_object(Key=key, Body=data, Metadata=metadata)
+    s3_client.put_object(Bucket=bucket, Key=key, Body=data, Metadata=metadata)
 
 
 # Reducer의 상태 정보를 bucket에 저장합니다.
-def write_reducer_state(n_reducers, n_s3, bucket, fname):
+# trace에는 이 step을 시작한 coordinator 실행의 시간 정보가 기록됩니다. (driver의 timeline/critical path 분석용)
+def write_reducer_state(n_reducers, n_s3, bucket, fname, trace=None):
     ts = time.time()
-    data = json.dumps({
+    state = {
         "reducerCount": '%s' % n_reducers,
         "totalS3Files": '%s' % n_s3,
         "start_time": '%s' % ts
-    })
+    }
+    state.update(trace or {})
+    data = json.dumps(state)
     write_to_s3(bucket, fname, data, {})
 
 
+# S3 event의 eventTime(ISO 8601, UTC)을 epoch seconds로 변환합니다.
+def parse_event_time(event_time):
+    try:
+        dt = datetime.datetime.strptime(event_time, "%Y-%m-%dT%H:%M:%S.%fZ")
+    except (TypeError, ValueError):
+        return None
+    return calendar.timegm(dt.timetuple()) + dt.microsecond / 1e6
+
+
+# 알림을 발생시킨 S3 key에서 job id를 찾습니다. (<deploymentId>/task/<job 접미사>/...)
+def get_job_id(key):
+    return s3io.job_id_of_task_key(key)
+
+
+# Job의 manifest(driver가 작성한 jobdata)를 가져옵니다.
+# driver가 job 종료 후 manifest를 지우므로, 늦게 도착한 알림에서는 None을 반환합니다.
+def read_job_manifest(bucket, job_id):
+    try:
+        response = s3_client.get_object(Bucket=bucket, Key="%s/jobdata" % job_id)
+    except s3_client.exceptions.NoSuchKey:
+        return None
+    return json.loads(response['Body'].read())
+
+
 # mapper의 파일 개수를 카운트 합니다. 파일 개수가 reducer의 step 수를 결정
-def get_mapper_files(files):
+def get_mapper_files(files, job_id):
+    prefix = s3io.task_prefix(job_id) + "mapper/"
     ret = []
     for mf in files:
-        if "task/mapper" in mf["Key"]:
+        if mf["Key"].startswith(prefix):
             ret.append(mf)
     return ret
 
@@ -69,14 +99,33 @@ def get_reducer_batch_size(keys):
 
 
 # 작업이 끝났는 지 확인합니다.
-def check_job_done(files):
-    # TODO: USE re
+def check_job_done(files, job_id):
     for f in files:
-        if "result" in f["Key"]:
+        if f["Key"] == job_id + "/result":
             return True
     return False
 
 
+# 다음 step이 시작된 후에는 더 이상 필요 없는 중간 파일을 찾습니다.
+# step_number의 출력을 입력으로 하는 step이 방금 시작되었으므로,
+# step_number보다 이전 단계의 출력(step_number의 입력)과 이전 reducerstate 파일은 모두 소비되었습니다.
+def get_consumed_files(files, job_id, step_number):
+    task_prefix = s3io.task_prefix(job_id)
+    consumed = []
+    for f in files:
+        fname = f['Key']
+        if "reducerstate." in fname:
+            if int(fname.rsplit('.', 1)[1]) <= step_number:
+                consumed.append(fname)
+        elif fname.startswith(task_prefix + "mapper/"):
+            if step_number >= 1:
+                consumed.append(fname)
+        elif fname.startswith(task_prefix + "reducer/"):
+            if int(fname[len(task_prefix + "reducer/"):].split('/')[0]) < step_number:
+                consumed.append(fname)
+    return consumed
+
+
 # Reducer의 state 정보를 Bucket에서 가져옵니다.
 def get_reducer_state_info(files, job_id, job_bucket):
     reducers = [];
@@ -89,27 +138,23 @@ def get_reducer_state_info(files, job_id, job_bucket):
     # 마지막 Reducer step인지 결정합니다.
     for f in files:
         if "reducerstate." in f['Key']:
-            idx = int(f['Key'].split('.')[1])
+            idx = int(f['Key'].rsplit('.', 1)[1])
             if idx > r_index:
                 r_index = idx
             reducer_step = True
 
     # Reducer의 상태가 완료인지 확인합니다. 
     if reducer_step == False:
-        return [MAPPERS_DONE, get_mapper_files(files)]
+        return [MAPPERS_DONE, get_mapper_files(files, job_id)]
     else:
         # Reduce steop이 완료되었다면 Bucket에 작성합니다.
         key = "%s/reducerstate.%s" % (job_id, r_index)
         response = s3_client.get_object(Bucket=job_bucket, Key=key)
         contents = json.loads(response['Body'].read())
 
+        rFname = '%sreducer/%s/' % (s3io.task_prefix(job_id), r_index)
         for f in files:
-            fname = f['Key']
-            parts = fname.split('/')
-            if len(parts) < 3:
-                continue
-            rFname = 'reducer/' + str(r_index)
-            if rFname in fname:
+            if f['Key'].startswith(rFname):
                 reducers.append(f)
 
         if int(contents["reducerCount"]) == len(reducers):
@@ -125,26 +170,39 @@ def lambda_handler(event, context):
 
     # Job Bucket으로 이 Bucket으로부터 notification을 받습니다.
     bucket = event['Records'][0]['s3']['bucket']['name']
-    config = json.loads(open('./jobinfo.json', "r").read())
+    key = urllib.parse.unquote_plus(event['Records'][0]['s3']['object']['key'])
+
+    # 하나의 coordinator가 여러 job을 처리하므로, 알림이 온 key에서 job을 찾습니다.
+    job_id = get_job_id(key)
+    if job_id is None:
+        print("Not a task output, ignoring", key)
+        return
+
+    config = read_job_manifest(bucket, job_id)
+    if config is None:
+        print("Job manifest not found (job already finished), ignoring", key)
+        return
 
-    job_id = config["jobId"]
     map_count = config["mapCount"]
     r_function_name = config["reducerFunction"]
     r_handler = config["reducerHandler"]
 
     ### Mapper 완료된 수를 count 합니다. ###
 
-    # Job 파일들을 가져옵니다.
-    files = s3_client.list_objects(Bucket=bucket, Prefix=job_id)["Contents"]
+    # Job 파일들을 가져옵니다. (중간 파일은 GC 되므로 목록의 크기는 한 단계 분량으로 유지됩니다)
+    files = lambdautils.list_job_files(s3_client, bucket, job_id)
 
-    if check_job_done(files) == True:
+    if check_job_done(files, job_id) == True:
         print("Job done!!! Check the result file")
         return
     else:
-        mapper_keys = get_mapper_files(files)
+        mapper_keys = get_mapper_files(files, job_id)
         print("Mappers Done so far ", len(mapper_keys))
 
-        if map_count == len(mapper_keys):
+        # reducer step이 시작된 후에는 mapper 출력이 GC 되었을 수 있습니다.
+        reducer_started = any("reducerstate." in f['Key'] for f in files)
+
+        if reducer_started or map_count == len(mapper_keys):
 
             # 모든 mapper가 완료되었다면, reducer를 시작합니다.
             stepInfo = get_reducer_state_info(files, job_id, bucket)
@@ -170,6 +228,17 @@ def lambda_handler(event, context):
             n_s3 = n_reducers * len(r_batch_params[0])
             step_id = step_number + 1
 
+            coordinator_trace = {
+                "coordinatorStart": start_time,
+                "triggerKey": key,
+                "triggerTime": parse_event_time(event['Records'][0].get('eventTime'))
+            }
+
+            # Reducer의 상태를 S3에 저장합니다.
+            # 마지막 reducer가 완료 후 상태 파일을 지우므로 reducer를 호출하기 전에 저장합니다.
+            fname = "%s/reducerstate.%s" % (job_id, step_id)
+            write_reducer_state(n_reducers, n_s3, bucket, fname, coordinator_trace)
+
             for i in range(len(r_batch_params)):
                 batch = [b['Key'] for b in r_batch_params[i]]
 
@@ -184,13 +253,20 @@ def lambda_handler(event, context):
                         "jobId": job_id,
                         "nReducers": n_reducers,
                         "stepId": step_id,
-                        "reducerId": i
+                        "reducerId": i,
+                        "memoryBudgetMB": config.get("memoryBudgetMB"),
+                        "aggregation": config.get("aggregation"),
+                        "resultShards": config.get("resultShards"),
+                        "hashedKeys": config.get("hashedKeys", False),
+                        "retainIntermediate": config.get("retainIntermediate", False),
+                        "coordinator": coordinator_trace
                     })
                 )
                 print(resp)
 
-            # Reducer의 상태를 S3에 저장합니다.
-            fname = "%s/reducerstate.%s" % (job_id, step_id)
-            write_reducer_state(n_reducers, n_s3, bucket, fname)
+            # 이미 소비된 이전 단계의 중간 파일을 제거합니다. (retainIntermediate: 디버깅을 위해 보존)
+            if not config.get("retainIntermediate", False):
+                consumed = get_consumed_files(files, job_id, step_number)
+                print("Deleted consumed intermediate files", lambdautils.delete_keys(s3_client, bucket, consumed))
         else:
             print("Still waiting for all the mappers to finish ..")
@@ -0,0 +1,142 @@
+'''
+Benchmark S3 request throughput under throttling (503 SlowDown) against a local fault-injecting S3 stand-in
+'''
+
+import argparse
+import io
+import random
+import threading
+import time
+
+from botocore.exceptions import ClientError
+from multiprocessing.dummy import Pool as ThreadPool
+
+import s3io
+
+
+class FaultInjectingS3(object):
+    '''
+    메모리에 object를 저장하는 S3 대용품입니다.
+    prefix(key의 마지막 '/'까지)마다 초당 요청 수를 token bucket으로 제한하고,
+    한도를 넘는 요청과 error_rate 비율의 요청에는 503 SlowDown을 반환합니다.
+    '''
+
+    def __init__(self, prefix_rate=200.0, burst=None, latency=0.002, error_rate=0.0):
+        self.prefix_rate = prefix_rate
+        self.burst = prefix_rate / 10.0 if burst is None else burst
+        self.latency = latency
+        self.error_rate = error_rate
+        self.objects = {}
+        self.tokens = {}  # prefix -> (남은 token, 마지막 갱신 시간)
+        self.lock = threading.Lock()
+        self.requests = 0
+        self.throttled = 0
+
+    def _slow_down(self, operation):
+        return ClientError({"Error": {"Code": "SlowDown", "Message": "Please reduce your request rate."},
+                            "ResponseMetadata": {"HTTPStatusCode": 503}}, operation)
+
+    def _admit(self, key):
+        prefix = key[:key.rfind('/') + 1]
+        with self.lock:
+            self.requests += 1
+            now = time.monotonic()
+            tokens, last = self.tokens.get(prefix, (self.burst, now))
+            tokens = min(self.burst, tokens + (now - last) * self.prefix_rate)
+            admitted = tokens >= 1 and random.random() >= self.error_rate
+            self.tokens[prefix] = (tokens - 1 if admitted else tokens, now)
+            if not admitted:
+                self.throttled += 1
+        time.sleep(self.latency)
+        return admitted
+
+    def put_object(self, Bucket, Key, Body=b'', Metadata=None, **kwargs):
+        if not self._admit(Key):
+            raise self._slow_down("PutObject")
+        if isinstance(Body, str):
+            Body = Body.encode('utf-8')
+        self.objects[(Bucket, Key)] = (Body, Metadata or {})
+        return {"ETag": '"%x"' % hash(Body)}
+
+    def get_object(self, Bucket, Key, **kwargs):
+        if not self._admit(Key):
+            raise self._slow_down("GetObject")
+        body, metadata = self.objects[(Bucket, Key)]
+        return {"Body": io.BytesIO(body), "ContentLength": len(body), "Metadata": metadata}
+
+    def delete_objects(self, Bucket, Delete):
+        errors = []
+        for obj in Delete['Objects']:
+            if self._admit(obj['Key']):
+                self.objects.pop((Bucket, obj['Key']), None)
+            else:
+                errors.append({"Key": obj['Key'], "Code": "SlowDown", "Message": "Please reduce your request rate."})
+        return {"Errors": errors} if errors else {}
+
+
+def run(new_client, tasks, objects_per_task, hashed, threads):
+    '''
+    mapper처럼 task마다 중간 파일을 쓰고, reducer처럼 다시 읽은 후 지웁니다.
+    task는 각각 다른 Lambda container처럼 자신의 client와 rate limiter를 사용합니다.
+    '''
+    job_id = "bench/%s" % time.time()
+    failed = [0]
+
+    def task(t_id):
+        client = new_client()
+        keys = [s3io.task_key(job_id, "mapper/", "%s-%s" % (t_id, i), hashed) for i in range(objects_per_task)]
+        try:
+            for key in keys:
+                client.put_object(Bucket="bench", Key=key, Body=b'{}', Metadata={})
+            for key in keys:
+                client.get_object(Bucket="bench", Key=key)['Body'].read()
+            client.delete_objects(Bucket="bench", Delete={'Objects': [{'Key': k} for k in keys], 'Quiet': True})
+        except ClientError:
+            failed[0] += 1
+
+    start = time.time()
+    pool = ThreadPool(threads)
+    pool.map(task, range(tasks))
+    pool.close()
+    pool.join()
+    return time.time() - start, failed[0]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Measure S3 I/O throughput with client-side throttling")
+    parser.add_argument("--tasks", type=int, default=200, help="number of simulated mappers")
+    parser.add_argument("--objects", type=int, default=5, help="intermediate objects written per task")
+    parser.add_argument("--threads", type=int, default=64, help="concurrent tasks")
+    parser.add_argument("--prefix-rate", type=float, default=200.0, help="allowed requests/s per prefix")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="fraction of random 503 responses")
+    parser.add_argument("--latency", type=float, default=0.002, help="seconds per request")
+    args = parser.parse_args()
+
+    scenarios = [
+        # (이름, hashed key, adaptive rate limiting)
+        ("flat, backoff only", False, False),
+        ("flat, adaptive", False, True),
+        ("hashed, backoff only", True, False),
+        ("hashed, adaptive", True, True),
+    ]
+    print("%-20s %8s %10s %10s %8s %10s" % ("scenario", "time(s)", "requests", "throttled", "failed", "ops/s"))
+    for name, hashed, adaptive in scenarios:
+        fake = FaultInjectingS3(args.prefix_rate, latency=args.latency, error_rate=args.error_rate)
+
+        def new_client(fake=fake, adaptive=adaptive):
+            if adaptive:
+                limiter = s3io.AdaptiveRateLimiter()
+            else:
+                # botocore의 기본 재시도처럼 요청 속도는 조절하지 않고 backoff만 합니다.
+                limiter = s3io.AdaptiveRateLimiter(max_rate=float('inf'), decrease=1.0)
+            # 모든 경우에 같은 재시도 횟수를 사용합니다.
+            return s3io.ThrottledS3Client(fake, limiter, max_attempts=s3io.DEFAULT_MAX_ATTEMPTS)
+
+        time_in_secs, failed = run(new_client, args.tasks, args.objects, hashed, args.threads)
+        ops = args.tasks * (2 * args.objects + 1)
+        print("%-20s %8.2f %10s %10s %8s %10.1f" % (name, time_in_secs, fake.requests, fake.throttled, failed,
+                                                     ops / time_in_secs))
+
+
+if __name__ == "__main__":
+    main()
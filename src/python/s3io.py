@@ -0,0 +1,379 @@
+'''
+Throttle-aware S3 access and streaming S3 output (multipart upload)
+
+* Copyright 2016, Amazon.com, Inc. or its affiliates. All Rights Reserved.
+*
+* Licensed under the Amazon Software License (the "License").
+* You may not use this file except in compliance with the License.
+* A copy of the License is located at
+*
+* http://aws.amazon.com/asl/
+*
+* or in the "license" file accompanying this file. This file is distributed
+* on an "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either
+* express or implied. See the License for the specific language governing
+* permissions and limitations under the License.
+'''
+
+from collections import deque
+# Lambda에는 /dev/shm이 없어 multiprocessing의 Pool을 사용할 수 없으므로 thread executor를 사용합니다.
+from concurrent.futures import ThreadPoolExecutor
+import random
+import re
+import threading
+import time
+import zlib
+
+import boto3
+from botocore.client import Config
+from botocore.exceptions import ClientError, ConnectionError, ReadTimeoutError
+
+# S3가 요청 속도를 제한할 때 반환하는 오류 (503 SlowDown)
+THROTTLE_CODES = frozenset(["SlowDown", "503", "ServiceUnavailable", "RequestLimitExceeded",
+                            "Throttling", "ThrottlingException", "TooManyRequestsException"])
+# 재시도하지만 요청 속도는 줄이지 않는 일시적인 오류
+TRANSIENT_CODES = frozenset(["InternalError", "500", "RequestTimeout"])
+
+# prefix당 S3 요청 한도 (PUT/COPY/POST/DELETE 3,500/s, GET/HEAD 5,500/s)
+DEFAULT_MAX_RATE = 3500.0
+DEFAULT_MIN_RATE = 1.0
+DEFAULT_MAX_ATTEMPTS = 8
+BASE_BACKOFF = 0.05
+MAX_BACKOFF = 5.0
+# 실제 요청 속도를 측정할 때 사용하는 최근 요청 수
+RATE_SAMPLES = 50
+
+# S3 multipart upload의 최소 part 크기 (마지막 part 제외)
+MIN_PART_SIZE = 5 * 1024 * 1024
+DEFAULT_PART_SIZE = 8 * 1024 * 1024
+# 동시에 업로드하는 part 수. 메모리 사용량은 약 (DEFAULT_UPLOAD_THREADS + 1) * part_size 입니다.
+DEFAULT_UPLOAD_THREADS = 4
+
+
+class MultipartWriter(object):
+    '''
+    write()로 받은 데이터를 part 크기만큼 모아 S3 multipart upload로 병렬 전송합니다.
+    전체 출력을 메모리나 /tmp에 만들지 않으며, part 크기보다 작은 출력은 put_object 한 번으로 저장합니다.
+    여러 writer가 executor를 공유할 때는 part_slots(Semaphore)로 전체 writer의 업로드 중인 part 수를 제한할 수 있습니다.
+    '''
+
+    def __init__(self, s3_client, bucket, key, metadata=None, part_size=DEFAULT_PART_SIZE,
+                 executor=None, max_pending=DEFAULT_UPLOAD_THREADS, part_slots=None):
+        if part_size < MIN_PART_SIZE:
+            raise ValueError("part size must be at least %s bytes" % MIN_PART_SIZE)
+        self.s3_client = s3_client
+        self.bucket = bucket
+        self.key = key
+        self.metadata = metadata or {}
+        self.part_size = part_size
+        self.max_pending = max_pending
+        self.part_slots = part_slots
+        self.own_executor = executor is None
+        self.executor = ThreadPoolExecutor(max_pending) if executor is None else executor
+        self.upload_id = None
+        self.parts = []     # 업로드 중인 part의 future
+        self.done = []      # 완료된 part의 {"ETag", "PartNumber"}
+        self.buf = bytearray()
+        self.size = 0
+        self.closed = False
+
+    def write(self, data):
+        if isinstance(data, str):
+            data = data.encode('utf-8')
+        self.buf += data
+        self.size += len(data)
+        if len(self.buf) >= self.part_size:
+            self._upload_part()
+
+    def _upload_part(self):
+        if self.upload_id is None:
+            self.upload_id = self.s3_client.create_multipart_upload(
+                Bucket=self.bucket, Key=self.key, Metadata=self.metadata)['UploadId']
+        self._submit_part()
+        # 업로드가 밀리면 기다려서 메모리에 남는 part 수를 제한합니다.
+        while len(self.parts) > self.max_pending:
+            self.done.append(self.parts.pop(0).result())
+
+    def _submit_part(self):
+        body = self.buf
+        self.buf = bytearray()
+        if self.part_slots is not None:
+            self.part_slots.acquire()
+        future = self.executor.submit(self._put_part, len(self.done) + len(self.parts) + 1, body)
+        if self.part_slots is not None:
+            # 취소된 part도 slot을 반환합니다.
+            future.add_done_callback(lambda f: self.part_slots.release())
+        self.parts.append(future)
+
+    def _put_part(self, part_number, body):
+        response = self.s3_client.upload_part(Bucket=self.bucket, Key=self.key, UploadId=self.upload_id,
+                                              PartNumber=part_number, Body=body)
+        return {"ETag": response['ETag'], "PartNumber": part_number}
+
+    def close(self):
+        '''
+        남은 데이터를 업로드하고 object를 완성합니다.
+        '''
+        if self.closed:
+            return
+        self.closed = True
+        try:
+            if self.upload_id is None:
+                self.s3_client.put_object(Bucket=self.bucket, Key=self.key, Body=bytes(self.buf),
+                                          Metadata=self.metadata)
+                self.buf = bytearray()
+                return
+            if self.buf:
+                self._submit_part()
+            self.done += [f.result() for f in self.parts]
+            self.parts = []
+            self.s3_client.complete_multipart_upload(
+                Bucket=self.bucket, Key=self.key, UploadId=self.upload_id,
+                MultipartUpload={"Parts": sorted(self.done, key=lambda p: p["PartNumber"])})
+            self.upload_id = None
+        except Exception:
+            self.abort()
+            raise
+        finally:
+            if self.own_executor:
+                self.executor.shutdown()
+
+    def abort(self):
+        '''
+        완료되지 않은 multipart upload를 취소합니다. (남은 part는 저장 비용이 발생합니다)
+        '''
+        self.closed = True
+        for f in self.parts:
+            f.cancel()
+        self.parts = []
+        self.buf = bytearray()
+        if self.upload_id is not None:
+            try:
+                self.s3_client.abort_multipart_upload(Bucket=self.bucket, Key=self.key, UploadId=self.upload_id)
+            except Exception as e:
+                print("Failed to abort multipart upload", self.key, e)
+            self.upload_id = None
+        if self.own_executor:
+            self.executor.shutdown(wait=False)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+        return False
+
+
+class AdaptiveRateLimiter(object):
+    '''
+    S3 요청 속도를 AIMD(additive increase, multiplicative decrease)로 조절합니다.
+    throttle 응답을 받으면 허용 속도와 실제로 측정된 요청 속도 중 작은 값을 일정 비율(decrease)로 줄이고,
+    요청이 성공하는 동안에는 초당 increase(요청/초)씩 늘립니다.
+    (요청 수가 아니라 시간에 비례해 늘리므로, 느려진 client가 몇 번의 성공만으로 다시 빨라지지 않습니다.)
+    허용 속도는 한도(max_rate)에서 시작하므로, 요청이 적은 client도 첫 throttle에서
+    실제 요청 속도 기준으로 바로 느려집니다. 같은 container의 모든 thread가 하나의 limiter를 공유합니다.
+    '''
+
+    def __init__(self, max_rate=DEFAULT_MAX_RATE, min_rate=DEFAULT_MIN_RATE, increase=1.0, decrease=0.7,
+                 clock=time.monotonic, sleep=time.sleep):
+        self.max_rate = max_rate
+        self.min_rate = min_rate
+        self.increase = increase
+        self.decrease = decrease
+        self.rate = max_rate
+        self.clock = clock
+        self.sleep = sleep
+        self.lock = threading.Lock()
+        self.next_time = 0.0
+        self.last_decrease = None
+        self.last_increase = None
+        self.sent = deque(maxlen=RATE_SAMPLES)  # 최근 요청의 시작 시간
+
+    def acquire(self):
+        '''
+        현재 허용 속도에 맞춰 다음 요청을 보낼 수 있을 때까지 기다립니다.
+        '''
+        with self.lock:
+            now = self.clock()
+            start = max(now, self.next_time)
+            self.next_time = start + 1.0 / self.rate
+            self.sent.append(start)
+        if start > now:
+            self.sleep(start - now)
+
+    def on_success(self):
+        with self.lock:
+            now = self.clock()
+            if self.last_increase is not None:
+                self.rate = min(self.max_rate, self.rate + self.increase * (now - self.last_increase))
+            self.last_increase = now
+
+    def measured_rate(self):
+        '''
+        최근 요청들의 실제 속도(요청/초). 측정할 수 없다면 None
+        '''
+        if len(self.sent) < 2 or self.sent[-1] <= self.sent[0]:
+            return None
+        return (len(self.sent) - 1) / (self.sent[-1] - self.sent[0])
+
+    def on_throttle(self):
+        with self.lock:
+            now = self.clock()
+            # 동시에 보낸 요청들의 throttle 응답으로 여러 번 줄이지 않도록 잠시 동안은 한 번만 줄입니다.
+            if self.last_decrease is not None and now - self.last_decrease < max(0.1, 1.0 / self.rate):
+                return
+            self.last_decrease = now
+            measured = self.measured_rate()
+            rate = self.rate if measured is None else min(self.rate, measured)
+            self.rate = max(self.min_rate, rate * self.decrease)
+
+
+def error_code(e):
+    '''
+    ClientError의 오류 코드. (코드가 없다면 HTTP status code)
+    '''
+    error = e.response.get('Error', {})
+    return error.get('Code') or str(e.response.get('ResponseMetadata', {}).get('HTTPStatusCode'))
+
+
+class ThrottledS3Client(object):
+    '''
+    boto3 S3 client의 API 호출을 rate limiter에 통과시키고,
+    throttle(503 SlowDown)과 일시적인 오류는 full jitter exponential backoff로 재시도합니다.
+    그 외의 속성(exceptions, meta 등)은 원래 client의 것을 그대로 사용합니다.
+    '''
+
+    def __init__(self, s3_client, limiter=None, max_attempts=DEFAULT_MAX_ATTEMPTS,
+                 base_backoff=BASE_BACKOFF, max_backoff=MAX_BACKOFF, sleep=time.sleep):
+        self.s3_client = s3_client
+        self.limiter = AdaptiveRateLimiter() if limiter is None else limiter
+        self.max_attempts = max_attempts
+        self.base_backoff = base_backoff
+        self.max_backoff = max_backoff
+        self.sleep = sleep
+        self.requests = 0
+        self.throttled = 0
+
+    def __getattr__(self, name):
+        attr = getattr(self.s3_client, name)
+        if not callable(attr) or name in ("can_paginate", "generate_presigned_url"):
+            return attr
+        return lambda **kwargs: self.call(attr, **kwargs)
+
+    def _backoff(self, attempt):
+        self.sleep(random.uniform(0, min(self.max_backoff, self.base_backoff * (2 ** attempt))))
+
+    def call(self, fn, **kwargs):
+        for attempt in range(self.max_attempts):
+            self.limiter.acquire()
+            self.requests += 1
+            try:
+                response = fn(**kwargs)
+            except ClientError as e:
+                code = error_code(e)
+                if code in THROTTLE_CODES:
+                    self.throttled += 1
+                    self.limiter.on_throttle()
+                elif code not in TRANSIENT_CODES:
+                    raise
+                if attempt + 1 == self.max_attempts:
+                    raise
+            except (ConnectionError, ReadTimeoutError):
+                if attempt + 1 == self.max_attempts:
+                    raise
+            else:
+                self.limiter.on_success()
+                return response
+            self._backoff(attempt)
+
+    def delete_objects(self, **kwargs):
+        '''
+        multi-object delete는 key별로 SlowDown을 반환할 수 있으므로 실패한 key만 다시 요청합니다.
+        '''
+        for attempt in range(self.max_attempts):
+            response = self.call(self.s3_client.delete_objects, **kwargs)
+            errors = response.get('Errors', [])
+            retry = [{'Key': err['Key']} for err in errors
+                     if err.get('Code') in THROTTLE_CODES or err.get('Code') in TRANSIENT_CODES]
+            if not retry or attempt + 1 == self.max_attempts:
+                return response
+            if any(err.get('Code') in THROTTLE_CODES for err in errors):
+                self.throttled += 1
+                self.limiter.on_throttle()
+            kwargs = dict(kwargs, Delete=dict(kwargs['Delete'], Objects=retry))
+            self._backoff(attempt)
+
+    def get_paginator(self, operation_name):
+        if operation_name == 'list_objects_v2':
+            return ListObjectsV2Paginator(self)
+        return self.s3_client.get_paginator(operation_name)
+
+
+class ListObjectsV2Paginator(object):
+    '''
+    list_objects_v2의 각 page를 ThrottledS3Client로 요청하는 paginator. (boto3 paginator는 이 layer를 거치지 않습니다)
+    '''
+
+    def __init__(self, client):
+        self.client = client
+
+    def paginate(self, **kwargs):
+        while True:
+            page = self.client.list_objects_v2(**kwargs)
+            yield page
+            if not page.get('IsTruncated'):
+                return
+            kwargs = dict(kwargs, ContinuationToken=page['NextContinuationToken'])
+
+
+# 같은 container(Lambda 실행 환경)의 모든 handler 호출이 공유하는 limiter
+_limiter = AdaptiveRateLimiter()
+
+
+def client():
+    '''
+    handler에서 사용하는 throttle-aware S3 client를 생성합니다.
+    재시도는 이 layer에서 하므로 botocore의 자체 재시도는 사용하지 않습니다.
+    '''
+    s3_client = boto3.client('s3', config=Config(retries={'max_attempts': 0}))
+    return ThrottledS3Client(s3_client, _limiter)
+
+
+# task 출력 key에서 job을 찾습니다. (<deploymentId>/task/<job 접미사>/mapper/... 또는 .../reducer/<step>/...)
+TASK_KEY_RE = re.compile(r'^([^/]+)/task/(.+)/(?:mapper|reducer/\d+)/')
+
+
+def task_prefix(job_id):
+    '''
+    job의 중간 파일이 저장되는 prefix (<deploymentId>/task/<job 접미사>/).
+    jobdata, reducerstate, stats 등 job의 다른 파일과 분리되어, coordinator를 호출하는 S3 알림을
+    <deploymentId>/task/ 아래의 task 출력으로 제한할 수 있습니다.
+    '''
+    deployment_id, name = job_id.split('/', 1)
+    return "%s/task/%s/" % (deployment_id, name)
+
+
+def job_id_of_task_key(key):
+    '''
+    task 출력 key의 job id. task 출력이 아니라면 None
+    '''
+    m = TASK_KEY_RE.match(key)
+    if m is None:
+        return None
+    return "%s/%s" % (m.group(1), m.group(2))
+
+
+def task_key(job_id, prefix, task_id, hashed=False):
+    '''
+    중간 파일의 key (<task_prefix><prefix><task_id>). prefix는 "mapper/" 또는 "reducer/<step>/" 입니다.
+    hashed이면 <task_prefix><prefix><hh>/<task_id> 처럼 hash 값의 prefix를 추가해
+    동시에 쓰는 많은 task의 요청이 여러 S3 prefix(partition)로 나뉘도록 합니다.
+    '''
+    key = "%s%s%s" % (task_prefix(job_id), prefix, task_id)
+    if not hashed:
+        return key
+    h = zlib.crc32(key.encode('utf-8')) & 0xff
+    return "%s%s%02x/%s" % (task_prefix(job_id), prefix, h, task_id)
@@ -0,0 +1,244 @@
+'''
+Mergeable approximate aggregations (HyperLogLog, Count-Min, top-K)
+
+* Copyright 2016, Amazon.com, Inc. or its affiliates. All Rights Reserved.
+*
+* Licensed under the Amazon Software License (the "License").
+* You may not use this file except in compliance with the License.
+* A copy of the License is located at
+*
+* http://aws.amazon.com/asl/
+*
+* or in the "license" file accompanying this file. This file is distributed
+* on an "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either
+* express or implied. See the License for the specific language governing
+* permissions and limitations under the License.
+'''
+
+from array import array
+import hashlib
+import math
+import struct
+import sys
+
+# 지원하는 aggregation 모드 ("sum"은 기존의 정확한 key별 합계)
+SUM = "sum"
+DISTINCT = "distinct"
+TOPK = "topk"
+
+HLL_MAGIC = b'HLL1'
+CMS_MAGIC = b'CMS1'
+TOPK_MAGIC = b'TOPK'
+
+
+def hash64(key):
+    '''
+    key의 64-bit hash 값을 계산합니다.
+    '''
+    return int.from_bytes(hashlib.blake2b(key.encode('utf-8'), digest_size=8).digest(), 'big')
+
+
+class HyperLogLog(object):
+    '''
+    서로 다른 key의 개수(distinct count)를 2^precision 바이트의 고정된 상태로 추정합니다.
+    상대 오차는 약 1.04 / sqrt(2^precision) 입니다.
+    '''
+
+    def __init__(self, precision=14, registers=None):
+        if not 4 <= precision <= 18:
+            raise ValueError("HyperLogLog precision must be between 4 and 18")
+        self.precision = precision
+        self.m = 1 << precision
+        self.registers = bytearray(self.m) if registers is None else bytearray(registers)
+
+    def update(self, key, value=None):
+        h = hash64(key)
+        idx = h >> (64 - self.precision)
+        rest = h & ((1 << (64 - self.precision)) - 1)
+        rank = (64 - self.precision) - rest.bit_length() + 1
+        if rank > self.registers[idx]:
+            self.registers[idx] = rank
+
+    def merge(self, other):
+        if not isinstance(other, HyperLogLog) or other.precision != self.precision:
+            raise ValueError("cannot merge HyperLogLog with different precision")
+        self.registers = bytearray(max(a, b) for a, b in zip(self.registers, other.registers))
+        return self
+
+    def estimate(self):
+        m = self.m
+        alpha = 0.7213 / (1 + 1.079 / m)
+        raw = alpha * m * m / sum(2.0 ** -r for r in self.registers)
+        zeros = self.registers.count(0)
+        if raw <= 2.5 * m and zeros > 0:
+            # 작은 범위에서는 linear counting이 더 정확합니다.
+            return m * math.log(float(m) / zeros)
+        return raw
+
+    def result(self):
+        return {"distinct": int(round(self.estimate()))}
+
+    def to_bytes(self):
+        return HLL_MAGIC + struct.pack('>B', self.precision) + bytes(self.registers)
+
+    @classmethod
+    def from_bytes(cls, data):
+        precision, = struct.unpack_from('>B', data, 4)
+        return cls(precision, data[5:5 + (1 << precision)])
+
+
+class CountMinSketch(object):
+    '''
+    key별 가중치 합을 width x depth 개의 counter로 추정합니다. (항상 실제 값 이상으로 추정)
+    '''
+
+    def __init__(self, width=2048, depth=5, counts=None):
+        self.width = width
+        self.depth = depth
+        self.counts = array('d', bytes(8 * width * depth)) if counts is None else counts
+
+    def _columns(self, key):
+        h = hash64(key)
+        h1 = h & 0xffffffff
+        h2 = (h >> 32) | 1
+        return [row * self.width + (h1 + row * h2) % self.width for row in range(self.depth)]
+
+    def update(self, key, value=1.0):
+        '''
+        가중치를 더하고, 갱신된 추정값을 반환합니다.
+        '''
+        est = None
+        for col in self._columns(key):
+            self.counts[col] += value
+            if est is None or self.counts[col] < est:
+                est = self.counts[col]
+        return est
+
+    def estimate(self, key):
+        return min(self.counts[col] for col in self._columns(key))
+
+    def merge(self, other):
+        if not isinstance(other, CountMinSketch) or (other.width, other.depth) != (self.width, self.depth):
+            raise ValueError("cannot merge CountMinSketch with different dimensions")
+        for i, c in enumerate(other.counts):
+            self.counts[i] += c
+        return self
+
+    def to_bytes(self):
+        counts = array('d', self.counts)
+        if sys.byteorder != 'little':
+            counts.byteswap()
+        return CMS_MAGIC + struct.pack('>II', self.width, self.depth) + counts.tobytes()
+
+    @classmethod
+    def from_bytes(cls, data):
+        width, depth = struct.unpack_from('>II', data, 4)
+        counts = array('d')
+        counts.frombytes(bytes(data[12:12 + 8 * width * depth]))
+        if sys.byteorder != 'little':
+            counts.byteswap()
+        return cls(width, depth, counts)
+
+
+class TopK(object):
+    '''
+    가중치 합이 가장 큰 k개의 key(heavy hitters)를 Count-Min sketch와 k개의 후보로 추정합니다.
+    '''
+
+    def __init__(self, k=100, width=2048, depth=5, cms=None, candidates=None):
+        self.k = k
+        self.cms = CountMinSketch(width, depth) if cms is None else cms
+        self.candidates = {} if candidates is None else candidates
+        self._min_est = 0.0  # 후보 중 최소 추정값의 하한 (추정값은 증가만 합니다)
+
+    def update(self, key, value=1.0):
+        est = self.cms.update(key, value)
+        if key in self.candidates or len(self.candidates) < self.k:
+            self.candidates[key] = est
+            return
+        if est <= self._min_est:
+            return
+        min_key = min(self.candidates, key=self.candidates.get)
+        self._min_est = self.candidates[min_key]
+        if est > self._min_est:
+            del self.candidates[min_key]
+            self.candidates[key] = est
+            self._min_est = min(self.candidates.values())
+
+    def merge(self, other):
+        if not isinstance(other, TopK) or other.k != self.k:
+            raise ValueError("cannot merge TopK with different k")
+        self.cms.merge(other.cms)
+        keys = set(self.candidates) | set(other.candidates)
+        merged = sorted(((self.cms.estimate(key), key) for key in keys), reverse=True)[:self.k]
+        self.candidates = dict((key, est) for est, key in merged)
+        self._min_est = min(self.candidates.values()) if self.candidates else 0.0
+        return self
+
+    def result(self):
+        top = sorted(self.candidates.items(), key=lambda kv: kv[1], reverse=True)
+        return dict(top)
+
+    def to_bytes(self):
+        out = [TOPK_MAGIC, struct.pack('>I', self.k)]
+        cms = self.cms.to_bytes()
+        out.append(struct.pack('>I', len(cms)))
+        out.append(cms)
+        out.append(struct.pack('>I', len(self.candidates)))
+        for key, est in self.candidates.items():
+            k = key.encode('utf-8')
+            out.append(struct.pack('>H', len(k)))
+            out.append(k)
+            out.append(struct.pack('>d', est))
+        return b''.join(out)
+
+    @classmethod
+    def from_bytes(cls, data):
+        k, cms_len = struct.unpack_from('>II', data, 4)
+        offset = 12
+        cms = CountMinSketch.from_bytes(data[offset:offset + cms_len])
+        offset += cms_len
+        n, = struct.unpack_from('>I', data, offset)
+        offset += 4
+        candidates = {}
+        for _ in range(n):
+            klen, = struct.unpack_from('>H', data, offset)
+            offset += 2
+            key = bytes(data[offset:offset + klen]).decode('utf-8')
+            offset += klen
+            candidates[key], = struct.unpack_from('>d', data, offset)
+            offset += 8
+        sketch = cls(k, cms=cms, candidates=candidates)
+        sketch._min_est = min(candidates.values()) if candidates else 0.0
+        return sketch
+
+
+def create(spec):
+    '''
+    job 설정의 aggregation spec으로 빈 sketch를 생성합니다.
+    예) {"type": "distinct", "precision": 14}, {"type": "topk", "k": 100, "width": 2048, "depth": 5}
+    '''
+    mode = spec.get("type", SUM)
+    if mode == DISTINCT:
+        return HyperLogLog(spec.get("precision", 14))
+    if mode == TOPK:
+        return TopK(spec.get("k", 100), spec.get("width", 2048), spec.get("depth", 5))
+    raise ValueError("Unknown sketch aggregation: %s" % mode)
+
+
+def load(data):
+    '''
+    to_bytes()로 직렬화된 sketch 상태를 읽습니다.
+    '''
+    magic = bytes(data[:4])
+    if magic == HLL_MAGIC:
+        return HyperLogLog.from_bytes(data)
+    if magic == TOPK_MAGIC:
+        return TopK.from_bytes(data)
+    if magic == CMS_MAGIC:
+        return CountMinSketch.from_bytes(data)
+    raise ValueError("Unknown sketch state")
+
+
+def is_sketch(spec):
+    return bool(spec) and spec.get("type", SUM) != SUM